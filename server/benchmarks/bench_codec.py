@@ -0,0 +1,73 @@
+"""Encodes and decodes random points with the per-point algorithm PositionCodec
+used before (distances, argsort and a 2x2 solve for each point) and with
+encode_many/decode_many, checking that both decode back to the same points.
+
+Both pick the same pair of answers except right next to an answer: the
+truncated answer points are not exactly on the circle, so there the nearest
+pair by distance can be a pair whose sector does not contain the point (and
+one of the weights comes out negative). encode_many always uses the sector of
+the point's angle.
+
+    python -m benchmarks.bench_codec [--points N] [--answers K]
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from src.context.position_format_utils import RADIUS, position_codec
+
+
+def encode_per_point(answer_points: np.ndarray, point: np.ndarray) -> np.ndarray:
+    # Previous implementation of PositionCodec.encode
+    distance_to_answers = np.sqrt(((answer_points - point) ** 2).sum(axis=-1))
+    closest_indices = np.argsort(distance_to_answers)[:2]
+    new_basis = answer_points[closest_indices]
+    point_new_basis = np.linalg.solve(new_basis.T, point)
+
+    encoded_position = np.zeros(answer_points.shape[0])
+    encoded_position[closest_indices] = point_new_basis
+    return encoded_position
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--points', type=int, default=100000, help="Points encoded. Default: 100000")
+    parser.add_argument('--answers', type=int, default=6, help="Answers of the question. Default: 6")
+    args = parser.parse_args()
+
+    codec = position_codec(args.answers)
+    rng = np.random.default_rng(0)
+    radii = RADIUS * np.sqrt(rng.random(args.points))
+    angles = rng.random(args.points) * 2 * np.pi
+    points = np.stack((radii * np.cos(angles), radii * np.sin(angles)), axis=1)
+
+    start = time.perf_counter()
+    expected = np.array([encode_per_point(codec.answer_points, point) for point in points])
+    per_point_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encoded = codec.encode_many(points)
+    many_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = np.array([codec.decode(row) for row in encoded])
+    decode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded_many = codec.decode_many(encoded)
+    decode_many_time = time.perf_counter() - start
+
+    assert np.allclose(decoded_many, points) and np.allclose(decoded, decoded_many)
+    assert np.allclose(codec.decode_many(expected), points)
+    same = np.isclose(encoded, expected).all(axis=1).sum()
+
+    print(f"points={args.points} answers={args.answers} same encoding={same / args.points:.2%}")
+    print(f"encode per point: {per_point_time * 1e3:9.2f} ms")
+    print(f"encode_many:      {many_time * 1e3:9.2f} ms ({per_point_time / many_time:6.1f}x)")
+    print(f"decode per row:   {decode_time * 1e3:9.2f} ms")
+    print(f"decode_many:      {decode_many_time * 1e3:9.2f} ms ({decode_time / decode_many_time:6.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Compares the per-message normalization loop that participant_update_handler
+used to run with the batched normalize_positions.
+
+    python -m benchmarks.bench_normalization [--rows N] [--answers K]
+"""
+import timeit
+from argparse import ArgumentParser
+
+import numpy as np
+
+from src.context.position_format_utils import normalize_positions
+
+
+def normalize_loop(position_data):
+    # Original implementation, applied to one message at a time
+    sum_position = 0
+    for i, position in enumerate(position_data):
+        if position < 0:
+            position_data[i] = 0
+        sum_position += position_data[i]
+    if sum_position > 1:
+        for i in range(len(position_data)):
+            position_data[i] = position_data[i] / sum_position
+    return position_data
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000, help="Updates per batch. Default: 10000")
+    parser.add_argument('--answers', type=int, default=6, help="Weights per update. Default: 6")
+    parser.add_argument('--repeat', type=int, default=5, help="Timing repetitions. Default: 5")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    batch = rng.uniform(-0.3, 0.7, size=(args.rows, args.answers))
+    messages = batch.tolist()
+
+    expected = np.array([normalize_loop(list(message)) for message in messages], dtype=float)
+    if not np.array_equal(normalize_positions(batch), expected):
+        raise SystemExit("normalize_positions does not match the per-message loop")
+
+    loop_time = min(timeit.repeat(
+        lambda: [normalize_loop(list(message)) for message in messages],
+        number=1, repeat=args.repeat,
+    ))
+    batch_time = min(timeit.repeat(
+        lambda: normalize_positions(np.array(messages)),
+        number=1, repeat=args.repeat,
+    ))
+    block_time = min(timeit.repeat(
+        lambda: normalize_positions(batch),
+        number=1, repeat=args.repeat,
+    ))
+
+    print(f"rows={args.rows} answers={args.answers}")
+    print(f"python loop:          {loop_time * 1e3:8.2f} ms ({loop_time / args.rows * 1e9:7.1f} ns/update)")
+    print(f"numpy from lists:     {batch_time * 1e3:8.2f} ms ({batch_time / args.rows * 1e9:7.1f} ns/update)")
+    print(f"numpy on block:       {block_time * 1e3:8.2f} ms ({block_time / args.rows * 1e9:7.1f} ns/update)")
+    print(f"speed-up on block:    {loop_time / block_time:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
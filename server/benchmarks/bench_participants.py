@@ -0,0 +1,75 @@
+"""Joins thousands of participants to a Session the way the
+/api/session/<id>/participants endpoint does, and compares it with the linear
+scans that endpoint used to run on every join.
+
+    python -m benchmarks.bench_participants [--participants N]
+"""
+import time
+from argparse import ArgumentParser
+
+from src.context import Participant, Session
+
+from .local_sessions import setup_local_sessions
+
+
+def join_with_scans(participants: dict, username: str):
+    # Previous implementation: one scan in the endpoint plus one in add_participant
+    if any(username.lower() == participant.username.lower() and participant.status != Participant.Status.OFFLINE
+           for participant in participants.values()):
+        return None
+    for participant in participants.values():
+        if participant.username.lower() == username.lower():
+            participant.status = Participant.Status.JOINED
+            return participant
+    participant = Participant(username)
+    participants[participant.id] = participant
+    return participant
+
+
+def join_with_index(session: Session, username: str):
+    joined = session.find_participant(username)
+    if joined is not None and joined.status != Participant.Status.OFFLINE:
+        return None
+    return session.add_participant(username)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--participants', type=int, default=5000, help="Participants that join. Default: 5000")
+    args = parser.parse_args()
+
+    setup_local_sessions()
+    usernames = [f"Student{i}" for i in range(args.participants)]
+
+    participants = {}
+    start = time.perf_counter()
+    for username in usernames:
+        join_with_scans(participants, username)
+    scans_time = time.perf_counter() - start
+
+    session = Session()
+    start = time.perf_counter()
+    for username in usernames:
+        join_with_index(session, username)
+    index_time = time.perf_counter() - start
+
+    for participant in list(session.participants.values())[::2]:
+        participant.status = Participant.Status.READY
+    for participant in list(session.participants.values())[1::4]:
+        session.remove_participant(participant.id)
+    rejoined = join_with_index(session, usernames[1].upper())
+    assert rejoined is not None and rejoined.status == Participant.Status.JOINED
+    assert join_with_index(session, usernames[0].lower()) is None
+    assert session.ready_participants_count == sum(
+        p.status == Participant.Status.READY for p in session.participants.values())
+    assert session.offline_participants_count == sum(
+        p.status == Participant.Status.OFFLINE for p in session.participants.values())
+
+    print(f"participants={args.participants}")
+    print(f"linear scans: {scans_time * 1e3:9.2f} ms ({scans_time / args.participants * 1e6:8.2f} us/join)")
+    print(f"index:        {index_time * 1e3:9.2f} ms ({index_time / args.participants * 1e6:8.2f} us/join)")
+    print(f"speed-up:     {scans_time / index_time:9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Serves question files from QuestionAssetCache against a bucket mocked with
+moto (pip install moto) and counts the S3 GetObject calls, checking that:
+
+    - a pinned question is revalidated once when it is pinned and then served
+      from memory after its TTL has expired, with no S3 round trip
+    - an unpinned question is revalidated with a conditional GET once its TTL
+      has expired
+    - a file changed in S3 while pinned is picked up when pinned again
+
+    python -m benchmarks.bench_question_cache [--requests N]
+"""
+import time
+from argparse import ArgumentParser
+
+import boto3
+from moto import mock_aws
+
+from src.context.question_cache import QuestionAssetCache
+
+BUCKET = 'hans-platform-collections'
+TTL = 0.2
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--requests', type=int, default=100000, help="Requests served from memory. Default: 100000")
+    args = parser.parse_args()
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=BUCKET)
+        pinned = QuestionAssetCache.question_key('Collection', 'Question1', 'info.json')
+        unpinned = QuestionAssetCache.question_key('Collection', 'Question2', 'info.json')
+        for key in (pinned, unpinned):
+            s3.put_object(Bucket=BUCKET, Key=key, Body=b'{"question": "v1"}')
+
+        calls = []
+        s3.meta.events.register('provide-client-params.s3.GetObject',
+                                lambda params, **kwargs: calls.append(params['Key']))
+        cache = QuestionAssetCache(s3, BUCKET, ttl=TTL)
+
+        cache.get(pinned)
+        cache.get(unpinned)
+        cache.pin([pinned])
+        cache.get(pinned)
+        assert calls == [pinned, unpinned, pinned], f"Pinning must revalidate once: {calls}"
+
+        time.sleep(TTL * 2)
+        calls.clear()
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            cache.get(pinned)
+        elapsed = time.perf_counter() - start
+        cache.get(unpinned)
+        assert calls == [unpinned], f"Only the unpinned file must go to S3 after the TTL: {calls}"
+
+        s3.put_object(Bucket=BUCKET, Key=pinned, Body=b'{"question": "v2"}')
+        assert cache.get(pinned).body == b'{"question": "v1"}'
+        cache.unpin([pinned])
+        cache.pin([pinned])
+        assert cache.get(pinned).body == b'{"question": "v2"}', "Pinning again must pick up the new file"
+
+        print(f"pinned after TTL: {args.requests} requests, 0 S3 calls, "
+              f"{elapsed / args.requests * 1e9:.0f} ns/request")
+        print(f"stats: {cache.stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+"""Load test of a whole server: thousands of simulated participants join a
+session through /api/session/<id>/participants, get ready on
+swarm/session/<id>/control/<pid> and send updates on
+swarm/session/<id>/updates/<pid> at a fixed rate, like the web client does.
+
+By default the server is started as a separate process (python -m src.main,
+which starts mosquitto through BrokerWrapper) in a temporary folder, so its
+CPU and RSS can be measured on their own. The folder is removed at the end
+unless --keep is given. --api-url attaches to a server that
+is already running instead.
+
+    python -m benchmarks.load_test [--participants N] [--rate HZ] [--duration S] [--output result.json]
+
+The result is a JSON document with:
+    join       joins per second and latency of the join requests
+    updates    updates sent and logged, dropped ones (sent but not in the
+               log of the session) and throughput
+    latency_ms publish-to-log latency: time from publishing an update until
+               its row appears in log.csv (includes the writer flush interval)
+    server     CPU and RSS of the server process, sampled from /proc
+"""
+import json
+import os
+import random
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+from src.context.position_format_utils import epoch_ms_to_iso, iso_to_epoch_ms
+from src.context.update_format import encode_update
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+ADMIN = {'user': 'admin', 'pass': 'admin'}
+
+
+def percentiles(values) -> dict:
+    if len(values) == 0:
+        return {'samples': 0}
+    values = np.asarray(values, dtype=float)
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'samples': len(values), 'p50': p50, 'p90': p90, 'p99': p99, 'max': float(values.max())}
+
+
+def api_request(api_url: str, path: str, body: Optional[dict] = None):
+    request = urllib.request.Request(
+        api_url + path,
+        data=json.dumps(body).encode() if body is not None else None,
+        headers={'Content-Type': 'application/json'},
+        method='POST' if body is not None else 'GET',
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+class ProcessSampler(threading.Thread):
+    '''
+        Samples the CPU time, RSS and threads of a process from /proc.
+    '''
+    def __init__(self, pid: int, interval: float = 0.5):
+        threading.Thread.__init__(self, name='process-sampler', daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def sample(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            # The command name may contain spaces: the fields start after ')'
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{self.pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        return time.monotonic(), cpu_seconds, int(status['VmRSS'].split()[0]) / 1024, int(status['Threads'])
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.samples.append(self.sample())
+            except OSError:
+                return
+
+    def result(self) -> dict:
+        if len(self.samples) < 2:
+            return {'pid': self.pid}
+        times, cpu, rss, threads = (np.array(column) for column in zip(*self.samples))
+        cpu_percent = 100 * np.diff(cpu) / np.diff(times)
+        return {
+            'pid': self.pid,
+            'cpu_percent_avg': 100 * (cpu[-1] - cpu[0]) / (times[-1] - times[0]),
+            'cpu_percent_max': float(cpu_percent.max()),
+            'rss_mb_max': float(rss.max()),
+            'rss_mb_end': float(rss[-1]),
+            'threads_max': int(threads.max()),
+        }
+
+
+class LogTail(threading.Thread):
+    '''
+        Follows the log.csv of the session and records, for every row, the
+        time since the update was published (its timeStamp).
+    '''
+    def __init__(self, session_log: Path, started_after: float):
+        threading.Thread.__init__(self, name='log-tail', daemon=True)
+        self.session_log = session_log
+        self.started_after = started_after
+        self.latencies: List[float] = []
+        self.rows = 0
+        self.stopped = threading.Event()
+
+    def _find_log(self) -> Optional[Path]:
+        if not self.session_log.is_dir():
+            return None
+        folders = [
+            folder for folder in self.session_log.iterdir()
+            if (folder / 'log.csv').is_file() and folder.stat().st_mtime >= self.started_after
+        ]
+        return max(folders, key=lambda folder: folder.stat().st_mtime) / 'log.csv' if folders else None
+
+    def run(self):
+        log_path = None
+        while log_path is None and not self.stopped.wait(0.05):
+            log_path = self._find_log()
+        if log_path is None:
+            return
+        with open(log_path) as f:
+            pending = ''
+            while True:
+                data = f.read()
+                if data:
+                    now_ms = time.time() * 1000
+                    lines = (pending + data).split('\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        fields = line.split(',', 2)
+                        if len(fields) == 3 and fields[0] != '0':
+                            self.latencies.append(now_ms - iso_to_epoch_ms(fields[1]))
+                            self.rows += 1
+                elif self.stopped.wait(0.01):
+                    return
+
+
+class ParticipantConnection(threading.Thread):
+    '''
+        One broker connection that publishes for a group of participants: a
+        few connections are enough to simulate thousands of browsers.
+    '''
+    def __init__(self, index: int, host: str, port: int, session_id: int, participant_ids: List[int],
+                 answers: int, rate: float, binary: bool):
+        threading.Thread.__init__(self, name=f'participants-{index}', daemon=True)
+        self.session_id = session_id
+        self.participant_ids = participant_ids
+        self.answers = answers
+        self.rate = rate
+        self.binary = binary
+        self.sent = 0
+        self.errors = 0
+        self.late_ticks = 0
+        self.sending = threading.Event()
+        self.stopped = threading.Event()
+        self.connected = threading.Event()
+        self.client = mqtt.Client(client_id=f"load-test-{os.getpid()}-{index}", transport="websockets")
+        self.client.ws_set_options(path="/")
+        self.client.on_connect = lambda client, obj, flags, rc: rc == 0 and self.connected.set()
+        self.client.connect_async(host, port)
+        self.client.loop_start()
+
+    def publish(self, topic: str, payload):
+        if self.client.publish(topic, payload).rc == mqtt.MQTT_ERR_SUCCESS:
+            return True
+        self.errors += 1
+        return False
+
+    def ready(self, participant_ids: List[int]):
+        for participant_id in participant_ids:
+            self.publish(f'swarm/session/{self.session_id}/control/{participant_id}', json.dumps({'type': 'ready'}))
+
+    def update_payload(self, participant_id: int, timestamp_ms: int, position: List[float]):
+        if self.binary:
+            return encode_update(participant_id, timestamp_ms, position)
+        return json.dumps({'data': {'position': position, 'timeStamp': epoch_ms_to_iso(timestamp_ms)}})
+
+    def run(self):
+        self.sending.wait()
+        period = 1 / self.rate
+        # Spread the connections over the period instead of all publishing at once
+        next_tick = time.monotonic() + random.random() * period
+        while not self.stopped.is_set():
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                self.late_ticks += 1
+            next_tick += period
+            for participant_id in self.participant_ids:
+                weights = np.random.dirichlet(np.ones(self.answers)).round(4).tolist()
+                payload = self.update_payload(participant_id, int(time.time() * 1000), weights)
+                if self.publish(f'swarm/session/{self.session_id}/updates/{participant_id}', payload):
+                    self.sent += 1
+
+    def close(self):
+        self.stopped.set()
+        self.sending.set()
+        if self.is_alive():
+            self.join()
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def start_server(workdir: Path, api_port: int, mqtt_port: int, server_args: str) -> subprocess.Popen:
+    # Without S3 credentials the server starts from an empty collection index
+    (workdir / 'collections.json').write_text('{}')
+    env = dict(os.environ, PYTHONPATH=str(SERVER_DIR))
+    command = [
+        sys.executable, '-m', 'src.main', '--api-port', str(api_port), '--mqtt-port', str(mqtt_port),
+        '--collections-index', str(workdir / 'collections.json'), *shlex.split(server_args),
+    ]
+    return subprocess.Popen(command, cwd=workdir, env=env,
+                            stdout=open(workdir / 'server.log', 'w'), stderr=subprocess.STDOUT)
+
+
+def wait_for_api(api_url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            api_request(api_url, '/api/session/0')
+            return
+        except urllib.error.HTTPError:
+            # 404: the API is up
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"The API did not answer at {api_url}")
+
+
+def wait_ready(api_url: str, session_id: int, connections: List[ParticipantConnection], timeout: float = 30):
+    # Until the server is connected to the broker the messages are lost, so
+    # 'ready' is sent again to the participants the server has not seen
+    deadline = time.monotonic() + timeout
+    while True:
+        participants = api_request(api_url, f'/api/session/{session_id}/allParticipants', ADMIN)
+        not_ready = {participant['id'] for participant in participants if participant['status'] != 'ready'}
+        if not not_ready:
+            return
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{len(not_ready)} participants did not get ready")
+        for connection in connections:
+            connection.ready([pid for pid in connection.participant_ids if pid in not_ready])
+        time.sleep(1)
+
+
+def wait_for_job(api_url: str, session_id: int, timeout: float) -> dict:
+    """Post-session job of the last stop of a session, once it is done or failed"""
+    job_id = None
+    job = {}
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job_id = job_id or api_request(api_url, f'/api/session/{session_id}')['last_job_id']
+        if job_id:
+            job = api_request(api_url, f'/api/jobs/{job_id}')
+            if job['status'] in ('done', 'failed'):
+                break
+        time.sleep(0.2)
+    return job
+
+
+def logged_rows(api_url: str, session_id: int, job: dict) -> Optional[int]:
+    """Updates in the log written by a post-session job, from the log index"""
+    if job.get('status') != 'done':
+        return None
+    logs = api_request(api_url, f'/api/logs?session_id={session_id}&limit=500')['logs']
+    return next((entry['rows'] for entry in logs if entry['name'] == job['log']), None)
+
+
+def log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--participants', type=int, default=1000, help="Simulated participants. Default: 1000")
+    parser.add_argument('--rate', type=float, default=5, help="Updates per second per participant. Default: 5")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds sending updates. Default: 30")
+    parser.add_argument('--answers', type=int, default=6, help="Weights of each update. Default: 6")
+    parser.add_argument('--connections', type=int, default=20, help="Broker connections shared by the participants. Default: 20")
+    parser.add_argument('--join-workers', type=int, default=32, help="Concurrent join requests. Default: 32")
+    parser.add_argument('--binary', action='store_true', help="Send binary updates instead of JSON")
+    parser.add_argument('--api-port', type=int, default=18080, help="API port of the server started. Default: 18080")
+    parser.add_argument('--mqtt-port', type=int, default=19001, help="Broker websocket port. Default: 19001")
+    parser.add_argument('--server-args', default='', help="Extra options for the server started, e.g. '--server waitress'")
+    parser.add_argument('--api-url', help="Use the server running at this URL instead of starting one")
+    parser.add_argument('--server-pid', type=int, help="With --api-url, process whose CPU and RSS are reported")
+    parser.add_argument('--session-log', type=Path,
+                        help="With --api-url, session_log folder of the server to measure the latency")
+    parser.add_argument('--output', type=Path, help="File where the JSON result is written. Default: stdout")
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the temporary folder of the server started (logs, zips, server.log)")
+    args = parser.parse_args()
+
+    server = None
+    workdir = None
+    if args.api_url:
+        api_url = args.api_url.rstrip('/')
+        mqtt_host = urllib.parse.urlparse(api_url).hostname
+        server_pid, session_log = args.server_pid, args.session_log
+    else:
+        workdir = Path(tempfile.mkdtemp(prefix='load-test-'))
+        log(f"Starting the server in {workdir}")
+        server = start_server(workdir, args.api_port, args.mqtt_port, args.server_args)
+        api_url, mqtt_host = f"http://127.0.0.1:{args.api_port}", '127.0.0.1'
+        server_pid, session_log = server.pid, workdir / 'session_log'
+
+    sampler = None
+    connections: List[ParticipantConnection] = []
+    try:
+        wait_for_api(api_url, 30)
+        if server_pid:
+            sampler = ProcessSampler(server_pid)
+            sampler.start()
+        session_id = api_request(api_url, '/api/createSession', ADMIN)['id']
+
+        log(f"Joining {args.participants} participants to session {session_id}")
+        def join(i):
+            start = time.perf_counter()
+            participant = api_request(api_url, f'/api/session/{session_id}/participants', {'user': f"load{i}"})
+            return participant['id'], (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.join_workers) as executor:
+            joins = list(executor.map(join, range(args.participants)))
+        join_seconds = time.perf_counter() - start
+        participant_ids = [participant_id for participant_id, _ in joins]
+
+        groups = [participant_ids[i::args.connections] for i in range(args.connections)]
+        connections = [
+            ParticipantConnection(i, mqtt_host, args.mqtt_port, session_id, group, args.answers, args.rate, args.binary)
+            for i, group in enumerate(groups) if group
+        ]
+        admin_client = ParticipantConnection(len(connections), mqtt_host, args.mqtt_port, session_id, [], 0, 1, False)
+        for connection in connections + [admin_client]:
+            if not connection.connected.wait(30):
+                raise RuntimeError("Could not connect to the broker")
+            connection.start()
+        wait_ready(api_url, session_id, connections)
+
+        started_after = time.time() - 1
+        admin_client.publish(f'swarm/session/{session_id}/control', json.dumps({'type': 'start', 'duration': 0}))
+        tail = LogTail(session_log, started_after) if session_log else None
+        if tail:
+            tail.start()
+        time.sleep(1)
+
+        log(f"Sending updates for {args.duration} s")
+        start = time.perf_counter()
+        for connection in connections:
+            connection.sending.set()
+        time.sleep(args.duration)
+        for connection in connections:
+            connection.close()
+        send_seconds = time.perf_counter() - start
+        sent = sum(connection.sent for connection in connections)
+
+        # Updates still on their way to the server when the session stops are lost
+        time.sleep(2)
+        admin_client.publish(f'swarm/session/{session_id}/control', json.dumps({'type': 'stop', 'mode': ''}))
+        job = wait_for_job(api_url, session_id, 60)
+        admin_client.close()
+        logged = logged_rows(api_url, session_id, job)
+        if tail:
+            time.sleep(0.5)
+            tail.stopped.set()
+            tail.join()
+            if logged is None:
+                logged = tail.rows
+
+        result = {
+            'config': {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+            'session_id': session_id,
+            'join': {
+                'participants': len(participant_ids),
+                'seconds': join_seconds,
+                'per_s': len(participant_ids) / join_seconds,
+                'latency_ms': percentiles([latency for _, latency in joins]),
+            },
+            'updates': {
+                'sent': sent,
+                'logged': logged,
+                'dropped': sent - logged if logged is not None else None,
+                'drop_rate': (sent - logged) / sent if logged is not None and sent else None,
+                'send_rate_per_s': sent / send_seconds,
+                'target_rate_per_s': len(participant_ids) * args.rate,
+                'publish_errors': sum(connection.errors for connection in connections),
+                'late_ticks': sum(connection.late_ticks for connection in connections),
+            },
+            'latency_ms': percentiles(tail.latencies) if tail else None,
+            'server': sampler.result() if sampler else None,
+        }
+    finally:
+        if sampler:
+            sampler.stopped.set()
+        for connection in connections:
+            connection.stopped.set()
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(15)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+        if workdir is not None:
+            if args.keep:
+                log(f"Server folder kept in {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        args.output.write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
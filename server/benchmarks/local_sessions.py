@@ -0,0 +1,30 @@
+"""Setup shared by the benchmarks that run Sessions in their own process,
+calling their handlers directly instead of going through a server.
+"""
+import atexit
+import os
+import tempfile
+from typing import Optional
+
+from src.context import AppContext, SessionRouter
+from src.services.mqtt import BrokerWrapper
+
+
+def setup_local_sessions(workdir_prefix: Optional[str] = None):
+    """Lets Sessions be created without a broker. With workdir_prefix the
+    logs, zips and trajectories are written to a temporary folder, removed at
+    exit"""
+    if workdir_prefix is not None:
+        cwd = os.getcwd()
+        workdir = tempfile.TemporaryDirectory(prefix=workdir_prefix, ignore_cleanup_errors=True)
+        os.chdir(workdir.name)
+
+        def cleanup():
+            os.chdir(cwd)
+            workdir.cleanup()
+        atexit.register(cleanup)
+    # No clients listen to the aggregate
+    AppContext.args.aggregate_tick = 0
+    # Neither the broker nor the router are started: sessions only need them to exist
+    AppContext.mqtt_broker = BrokerWrapper('localhost', AppContext.args.mqtt_port)
+    AppContext.mqtt_router = SessionRouter('localhost', AppContext.args.mqtt_port)
@@ -0,0 +1,369 @@
+"""Replays recorded sessions: the updates of session_log/<time>/log.csv (or
+log.bin) are sent again with their original inter-arrival times divided by
+--speed, so real sessions become reproducible workloads.
+
+    python -m benchmarks.replay LOG_FOLDER [LOG_FOLDER ...] [--speed 10] [--target mqtt|handler]
+
+Each log is replayed as a new session with one participant per recorded
+participant id. Several logs are replayed at the same time, all of them
+starting at once, by merging their updates in time order with heapq.merge.
+The logs are read row by row while they are replayed (only the set of
+participant ids is collected beforehand), so the recordings do not need to
+fit in memory. --speed 0 sends the updates as fast as possible.
+
+Targets:
+    mqtt     publishes the updates on swarm/session/<id>/updates/<pid> of a
+             server started as a subprocess, like benchmarks.load_test, or of
+             the one at --api-url
+    handler  calls Session.participant_update_handler in this process and
+             times each call and the post-session job of the stop
+
+Prints a JSON document with the updates sent, how late they were sent
+compared to the recording (lag), and the timings of the target.
+"""
+import csv
+import heapq
+import json
+import random
+import signal
+import subprocess
+import tempfile
+import time
+import urllib.parse
+from argparse import ArgumentParser, ArgumentTypeError
+from itertools import count
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+from src.context import AppContext, Session
+from src.context.position_format_utils import iso_to_epoch_ms
+from src.context.session_log import iter_binary_log
+
+from .load_test import (ADMIN, ParticipantConnection, ProcessSampler, api_request, log, logged_rows, percentiles,
+                        start_server, wait_for_api, wait_for_job, wait_ready)
+from .local_sessions import setup_local_sessions
+
+# (participant_id, timestamp_ms, position) of a recorded update
+Update = Tuple[int, int, List[float]]
+
+
+def iter_log(log_folder: Path) -> Iterator[Update]:
+    """Updates of a session log in file order, read one row (or one block of
+    log.bin) at a time"""
+    if (log_folder / 'log.csv').is_file():
+        with open(log_folder / 'log.csv', newline='') as f:
+            for row in csv.reader(f):
+                if not row or row[0] == "0":
+                    continue
+                yield int(row[0]), iso_to_epoch_ms(row[1]), [float(value) for value in row[2:]]
+    elif (log_folder / 'log.bin').is_file():
+        for participant_ids, timestamps, widths, positions in iter_binary_log(log_folder / 'log.bin'):
+            for i in range(len(participant_ids)):
+                yield int(participant_ids[i]), int(timestamps[i]), positions[i, :widths[i]].tolist()
+    else:
+        raise FileNotFoundError(f"{log_folder} has neither log.csv nor log.bin")
+
+
+def recorded_participants(log_folder: Path) -> List[int]:
+    return sorted({participant_id for participant_id, _, _ in iter_log(log_folder)})
+
+
+def _offsets(index: int, updates: Iterator[Update]) -> Iterator[Tuple[int, int, int, List[float]]]:
+    first = next(updates, None)
+    if first is None:
+        return
+    start = first[1]
+    yield 0, index, first[0], first[2]
+    for participant_id, timestamp_ms, position in updates:
+        yield timestamp_ms - start, index, participant_id, position
+
+
+def replay_schedule(log_folders: Sequence[Path]) -> Iterator[Tuple[int, int, int, List[float]]]:
+    """(offset_ms, log index, participant_id, position) of the updates of all
+    the logs, each offset counted from the first update of its log. The rows
+    of a log are in arrival order, so the few whose client clock was behind
+    come out slightly before their time"""
+    streams = [_offsets(index, iter_log(folder)) for index, folder in enumerate(log_folders)]
+    return heapq.merge(*streams, key=lambda update: update[0])
+
+
+class Reservoir():
+    '''
+        Uniform sample of at most `size` values, so the percentiles of a long
+        replay are computed without keeping every value.
+    '''
+    def __init__(self, size: int = 100000):
+        self.size = size
+        self.values: List[float] = []
+        self.count = 0
+        self.random = random.Random(0)
+
+    def add(self, value: float):
+        self.count += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            i = self.random.randrange(self.count)
+            if i < self.size:
+                self.values[i] = value
+
+
+class Pacer():
+    '''
+        Waits until the time at which an update has to be sent: its offset in
+        the recording divided by the speed. Updates that are already late are
+        sent right away and their lag is recorded.
+    '''
+    def __init__(self, speed: float):
+        self.speed = speed
+        self.start = time.monotonic()
+        self.lag_ms = Reservoir()
+
+    def wait(self, offset_ms: int):
+        if self.speed <= 0:
+            return
+        delay = self.start + offset_ms / 1000 / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+            delay = 0
+        self.lag_ms.add(-delay * 1000)
+
+
+def wait_active(api_url: str, session_id: int, timeout: float):
+    # The updates sent before the 'start' is handled would not be logged
+    deadline = time.monotonic() + timeout
+    while api_request(api_url, f'/api/session/{session_id}')['status'] != 'active':
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Session {session_id} did not start")
+        time.sleep(0.05)
+
+
+class MqttTarget():
+    '''
+        Replays each log as a session of a real server, through the API and
+        the broker. The participants of a log share --connections clients.
+    '''
+    def __init__(self, api_url: str, mqtt_host: str, mqtt_port: int, connections: int, binary: bool):
+        self.api_url = api_url
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.connections = connections
+        self.binary = binary
+        self.session_ids: List[int] = []
+        self.participants: List[Dict[int, Tuple[int, ParticipantConnection]]] = []
+        self.clients: List[ParticipantConnection] = []
+        self.admin_clients: List[ParticipantConnection] = []
+        # Client ids must be unique in the broker
+        self.client_ids = count()
+        self.sent = 0
+
+    def prepare(self, log_folders: Sequence[Path]):
+        for folder in log_folders:
+            recorded = recorded_participants(folder)
+            session_id = api_request(self.api_url, '/api/createSession', ADMIN)['id']
+            new_ids = [
+                api_request(self.api_url, f'/api/session/{session_id}/participants',
+                            {'user': f"replay{participant_id}"})['id']
+                for participant_id in recorded
+            ]
+            clients = [
+                ParticipantConnection(next(self.client_ids), self.mqtt_host, self.mqtt_port, session_id,
+                                      new_ids[i::self.connections], 0, 1, self.binary)
+                for i in range(min(self.connections, len(new_ids)))
+            ]
+            admin_client = ParticipantConnection(next(self.client_ids), self.mqtt_host, self.mqtt_port, session_id,
+                                                 [], 0, 1, False)
+            for client in clients + [admin_client]:
+                if not client.connected.wait(30):
+                    raise RuntimeError("Could not connect to the broker")
+            wait_ready(self.api_url, session_id, clients)
+            self.session_ids.append(session_id)
+            self.participants.append({
+                participant_id: (new_id, clients[i % len(clients)])
+                for i, (participant_id, new_id) in enumerate(zip(recorded, new_ids))
+            })
+            self.clients.extend(clients)
+            self.admin_clients.append(admin_client)
+        for session_id, admin_client in zip(self.session_ids, self.admin_clients):
+            admin_client.publish(f'swarm/session/{session_id}/control', json.dumps({'type': 'start', 'duration': 0}))
+        for session_id in self.session_ids:
+            wait_active(self.api_url, session_id, 30)
+
+    def send(self, index: int, participant_id: int, position: List[float]):
+        new_id, client = self.participants[index][participant_id]
+        payload = client.update_payload(new_id, int(time.time() * 1000), position)
+        if client.publish(f'swarm/session/{self.session_ids[index]}/updates/{new_id}', payload):
+            self.sent += 1
+
+    def finish(self) -> dict:
+        # Updates still on their way to the server when the session stops are lost
+        time.sleep(2)
+        start = time.perf_counter()
+        for session_id, admin_client in zip(self.session_ids, self.admin_clients):
+            admin_client.publish(f'swarm/session/{session_id}/control', json.dumps({'type': 'stop', 'mode': ''}))
+        jobs = [wait_for_job(self.api_url, session_id, 120) for session_id in self.session_ids]
+        stop_seconds = time.perf_counter() - start
+        for client in self.clients + self.admin_clients:
+            client.close()
+        logged = [logged_rows(self.api_url, session_id, job) for session_id, job in zip(self.session_ids, jobs)]
+        return {
+            'sessions': self.session_ids,
+            'sent': self.sent,
+            'logged': sum(logged) if None not in logged else None,
+            'publish_errors': sum(client.errors for client in self.clients),
+            'jobs': [job.get('status') for job in jobs],
+            'stop_seconds': stop_seconds,
+        }
+
+
+class HandlerTarget():
+    '''
+        Replays each log as a Session of this process, calling its handlers
+        directly: no broker, no API. Everything is written to a temporary
+        folder.
+    '''
+    def __init__(self):
+        setup_local_sessions('replay-')
+        self.sessions: List[Session] = []
+        self.participants: List[Dict[int, int]] = []
+        self.handler_us = Reservoir()
+        self.sent = 0
+
+    def prepare(self, log_folders: Sequence[Path]):
+        for folder in log_folders:
+            session = Session()
+            AppContext.sessions[session.id] = session
+            participants = {}
+            for participant_id in recorded_participants(folder):
+                participants[participant_id] = session.add_participant(f"replay{participant_id}").id
+                session.participant_ready_handler(participants[participant_id])
+            session.session_start_handler(0)
+            self.sessions.append(session)
+            self.participants.append(participants)
+
+    def send(self, index: int, participant_id: int, position: List[float]):
+        new_id = self.participants[index][participant_id]
+        timestamp_ms = int(time.time() * 1000)
+        start = time.perf_counter()
+        self.sessions[index].participant_update_handler(new_id, timestamp_ms, position)
+        self.handler_us.add((time.perf_counter() - start) * 1e6)
+        self.sent += 1
+
+    @staticmethod
+    def logged_rows(session: Session, job) -> int:
+        _, logs = AppContext.log_index.query(session_id=session.id, limit=1)
+        return next((entry['rows'] for entry in logs if job and entry['name'] == job.log_name), 0)
+
+    def finish(self) -> dict:
+        start = time.perf_counter()
+        for session in self.sessions:
+            session.session_stop_handler('')
+        jobs = [session.last_job for session in self.sessions]
+        while any(job is not None and job.pending for job in jobs):
+            time.sleep(0.01)
+        stop_seconds = time.perf_counter() - start
+        return {
+            'sent': self.sent,
+            'logged': sum(self.logged_rows(session, job) for session, job in zip(self.sessions, jobs)),
+            'jobs': [job.status.value if job else None for job in jobs],
+            'handler_us': percentiles(self.handler_us.values),
+            'stop_seconds': stop_seconds,
+        }
+
+
+def speed(value: str) -> float:
+    if value == 'max':
+        return 0
+    try:
+        return float(value)
+    except ValueError:
+        raise ArgumentTypeError(f"{value} is not a number or 'max'")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('logs', type=Path, nargs='+', help="session_log/<time> folders replayed at the same time")
+    parser.add_argument('--speed', type=speed, default=1,
+                        help="Replay speed: 1 real time, 10 ten times faster, 0 or max as fast as possible. Default: 1")
+    parser.add_argument('--target', choices=['mqtt', 'handler'], default='mqtt',
+                        help="Where the updates are sent. Default: mqtt")
+    parser.add_argument('--connections', type=int, default=4,
+                        help="Broker connections per replayed session with --target mqtt. Default: 4")
+    parser.add_argument('--binary', action='store_true', help="Send binary updates instead of JSON")
+    parser.add_argument('--api-port', type=int, default=18080, help="API port of the server started. Default: 18080")
+    parser.add_argument('--mqtt-port', type=int, default=19001, help="Broker websocket port. Default: 19001")
+    parser.add_argument('--server-args', default='', help="Extra options for the server started, e.g. '--server waitress'")
+    parser.add_argument('--api-url', help="Use the server running at this URL instead of starting one")
+    parser.add_argument('--server-pid', type=int, help="With --api-url, process whose CPU and RSS are reported")
+    parser.add_argument('--output', type=Path, help="File where the JSON result is written. Default: stdout")
+    args = parser.parse_args()
+    log_folders = [folder.resolve() for folder in args.logs]
+
+    server = None
+    workdir = None
+    sampler = None
+    target = None
+    try:
+        if args.target == 'handler':
+            target = HandlerTarget()
+        else:
+            if args.api_url:
+                api_url = args.api_url.rstrip('/')
+                mqtt_host = urllib.parse.urlparse(api_url).hostname
+                server_pid = args.server_pid
+            else:
+                workdir = tempfile.TemporaryDirectory(prefix='replay-', ignore_cleanup_errors=True)
+                log(f"Starting the server in {workdir.name}")
+                server = start_server(Path(workdir.name), args.api_port, args.mqtt_port, args.server_args)
+                api_url, mqtt_host = f"http://127.0.0.1:{args.api_port}", '127.0.0.1'
+                server_pid = server.pid
+            wait_for_api(api_url, 30)
+            if server_pid:
+                sampler = ProcessSampler(server_pid)
+                sampler.start()
+            target = MqttTarget(api_url, mqtt_host, args.mqtt_port, args.connections, args.binary)
+
+        log(f"Preparing {len(log_folders)} sessions")
+        target.prepare(log_folders)
+        log(f"Replaying at speed {args.speed or 'max'}")
+        pacer = Pacer(args.speed)
+        last_offset_ms = 0
+        for offset_ms, index, participant_id, position in replay_schedule(log_folders):
+            pacer.wait(offset_ms)
+            target.send(index, participant_id, position)
+            last_offset_ms = max(last_offset_ms, offset_ms)
+        replay_seconds = time.monotonic() - pacer.start
+        result = {
+            'config': {key: [str(v) for v in value] if key == 'logs' else str(value) if isinstance(value, Path) else value
+                       for key, value in vars(args).items()},
+            'recorded_seconds': last_offset_ms / 1000,
+            'replay_seconds': replay_seconds,
+            'lag_ms': percentiles(pacer.lag_ms.values) if args.speed > 0 else None,
+            **target.finish(),
+        }
+        result['send_rate_per_s'] = result['sent'] / replay_seconds
+        result['server'] = sampler.result() if sampler else None
+    finally:
+        if sampler:
+            sampler.stopped.set()
+        if isinstance(target, MqttTarget):
+            for client in target.clients + target.admin_clients:
+                client.stopped.set()
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(15)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if workdir is not None:
+            workdir.cleanup()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        args.output.write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
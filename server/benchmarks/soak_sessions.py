@@ -0,0 +1,147 @@
+"""Creates, uses and closes sessions over and over and reports the RSS and the
+thread count of the process, which must stay flat once the first fifth of the
+cycles has warmed up the bounded histories and the worker threads.
+
+Each cycle creates a Session, joins participants, marks them ready, starts
+the session, sends updates, stops it and closes it. With --idle-timeout the
+sessions are not closed by hand but left to the idle eviction. Everything is
+written to a temporary folder.
+
+    python -m benchmarks.soak_sessions [--cycles N] [--participants P] [--idle-timeout S]
+
+Prints one JSON line per report and a JSON summary. The RSS is measured after
+gc.collect() and malloc_trim() at every report past the warm-up; the exit code is 1 if its
+least-squares slope over those reports is above --max-growth-kb (per cycle),
+it grew more than --max-growth-mb in total, or threads were left behind.
+"""
+import ctypes
+import gc
+import json
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+from src.context import AppContext, PostSessionPipeline, Session
+
+from .local_sessions import setup_local_sessions
+
+
+try:
+    # glibc keeps the memory freed by the worker threads in their arenas;
+    # returning it before measuring leaves the memory still in use
+    _malloc_trim = ctypes.CDLL('libc.so.6').malloc_trim
+except (OSError, AttributeError):
+    _malloc_trim = None
+
+
+def process_status() -> dict:
+    with open('/proc/self/status') as f:
+        fields = dict(line.split(':', 1) for line in f)
+    return {
+        'rss_mb': int(fields['VmRSS'].split()[0]) / 1024,
+        'threads': int(fields['Threads']),
+    }
+
+
+def growth_slope(samples) -> float:
+    """Least-squares slope of (cycle, rss_kb) samples, in KB per cycle. A
+    single sample has no slope"""
+    if len(samples) < 2:
+        return 0.0
+    mean_cycle = sum(cycle for cycle, _ in samples) / len(samples)
+    mean_rss = sum(rss for _, rss in samples) / len(samples)
+    return (sum((cycle - mean_cycle) * (rss - mean_rss) for cycle, rss in samples)
+            / sum((cycle - mean_cycle) ** 2 for cycle, _ in samples))
+
+
+def wait_for(condition, timeout: float):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def run_cycle(participants: int, updates: int, close: bool):
+    session = Session()
+    AppContext.sessions[session.id] = session
+    joined = [session.add_participant(f"Student{i}") for i in range(participants)]
+    for participant in joined:
+        session.participant_ready_handler(participant.id)
+    session.session_start_handler(0)
+    timestamp = int(time.time() * 1000)
+    for i in range(updates):
+        for participant in joined:
+            session.participant_update_handler(participant.id, timestamp + i, [0.5, 0.25, 0.25])
+    session.session_stop_handler('')
+    if close:
+        AppContext.close_session(session.id)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--cycles', type=int, default=5000, help="Sessions created and closed. Default: 5000")
+    parser.add_argument('--participants', type=int, default=10, help="Participants per session. Default: 10")
+    parser.add_argument('--updates', type=int, default=5, help="Updates per participant. Default: 5")
+    parser.add_argument('--idle-timeout', type=float, default=0,
+                        help="Leave the sessions to the idle eviction after this many seconds instead of closing them. "
+                             "Default: close them")
+    parser.add_argument('--report-every', type=int, default=250, help="Cycles between reports. Default: 250")
+    parser.add_argument('--max-growth-kb', type=float, default=1,
+                        help="RSS growth per cycle allowed after warm-up (slope over the reports). Default: 1")
+    parser.add_argument('--max-growth-mb', type=float, default=4, help="RSS growth allowed after warm-up. Default: 4")
+    args = parser.parse_args()
+
+    setup_local_sessions('soak-sessions-')
+    AppContext.args.session_idle_timeout = args.idle_timeout
+    # Both histories are bounded; small bounds fill up within the warm-up
+    AppContext.MAX_ARCHIVED_SESSIONS = 100
+    PostSessionPipeline.MAX_JOBS_KEPT = 100
+    AppContext.liveness.resolution = 0.1
+
+    close = args.idle_timeout <= 0
+    warm_up = max(1, args.cycles // 5)
+    baseline = None
+    samples = []
+    start = time.perf_counter()
+    for cycle in range(1, args.cycles + 1):
+        run_cycle(args.participants, args.updates, close)
+        if cycle == warm_up or cycle % args.report_every == 0 or cycle == args.cycles:
+            # Let the post-session jobs of the stopped sessions finish before measuring
+            wait_for(lambda: not any(job.pending for job in list(AppContext.post_session.jobs.values())), 60)
+            # Garbage waiting for a collection is not a leak
+            gc.collect()
+            if _malloc_trim:
+                _malloc_trim(0)
+            report = {'cycle': cycle, 'sessions': len(AppContext.sessions), **process_status()}
+            print(json.dumps(report), flush=True)
+            if cycle == warm_up:
+                baseline = report
+            if cycle >= warm_up:
+                samples.append((cycle, report['rss_mb'] * 1024))
+    elapsed = time.perf_counter() - start
+
+    if not close:
+        wait_for(lambda: not AppContext.sessions, args.idle_timeout + 10)
+    final = {'sessions': len(AppContext.sessions), 'timers': len(AppContext.liveness),
+             'routes': len(AppContext.mqtt_router.routes), **process_status()}
+    summary = {
+        'cycles': args.cycles,
+        'cycles_per_s': args.cycles / elapsed,
+        'baseline': baseline,
+        'final': final,
+        'rss_growth_mb': final['rss_mb'] - baseline['rss_mb'],
+        'rss_growth_kb_per_cycle': growth_slope(samples),
+        'thread_growth': final['threads'] - baseline['threads'],
+        'python_threads': [thread.name for thread in threading.enumerate()],
+    }
+    print(json.dumps(summary), flush=True)
+    leaked = final['sessions'] or final['timers'] or final['routes']
+    grew = (summary['rss_growth_kb_per_cycle'] > args.max_growth_kb
+            or summary['rss_growth_mb'] > args.max_growth_mb)
+    if leaked or grew or summary['thread_growth'] > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
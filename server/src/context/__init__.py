@@ -1,9 +1,19 @@
 from argparse import Namespace
 from pathlib import Path
-from typing import Dict
+from collections import OrderedDict
+from threading import Thread
+from typing import Dict, List, Optional
 import boto3
 from .participant import Participant
 from .session import Session
+from .post_session import PostSessionJob, PostSessionPipeline
+from .session_router import SessionRouter
+from .question_cache import QuestionAssetCache
+from .collection_index import CollectionIndex
+from .scheduler import Scheduler, TimerWheel
+from .log_index import LogIndex
+from .storage import FileStorage, SessionStorage, SqliteStorage
+from .metrics import REGISTRY
 COLLECTION_FOLDER = Path('questions')
 SESSION_LOG_FOLDER = Path('session_log')
 
@@ -11,34 +21,132 @@ class AppContext:
     args = Namespace(
         mqtt_port=9001,
         api_port=8080,
+        server='werkzeug',
+        api_threads=16,
+        api_connection_limit=1000,
+        api_shutdown_timeout=5.0,
+        log_format='csv',
+        post_session_workers=2,
+        post_session_shutdown_timeout=60.0,
+        question_cache_mb=64,
+        question_cache_ttl=60.0,
+        question_cache_dir=None,
+        collections_index=Path('tmp/collections_index.json'),
+        s3_list_workers=8,
+        log_index=Path('tmp/log_index.sqlite'),
+        session_store=None,
+        prefetch_ahead=1,
+        aggregate_tick=0.1,
+        # Off until the clients send 'alive' messages while they wait in the lobby
+        participant_timeout=0.0,
+        session_stop_grace=1.0,
+        auto_stop_mode='trajectories',
+        session_idle_timeout=3600.0,
     )
 
     mqtt_broker = None
+    mqtt_router: 'SessionRouter' = None
     api_service = None
 
+    post_session = PostSessionPipeline()
+    log_index = LogIndex()
+    # Where the sessions are saved. The files are always written; main.py adds
+    # the SQLite store when --session-store is given
+    file_storage = FileStorage()
+    storages: 'List[SessionStorage]' = [file_storage]
+    # Shown by /api/metrics
+    metrics = REGISTRY
+    # Timed tasks of every session
+    scheduler = Scheduler()
+    # Keep-alives of the participants of every session
+    liveness = TimerWheel(scheduler)
+
     sessions: 'Dict[Session]' = {}
+    # as_dict of the closed sessions, so their ids still resolve
+    archived_sessions: 'OrderedDict[int, dict]' = OrderedDict()
+    MAX_ARCHIVED_SESSIONS = 10000
     collections = {}
     # Configura el cliente de S3
     s3 = boto3.client('s3')
     bucket_name = 'hans-platform-collections'
+    question_cache = QuestionAssetCache(s3, bucket_name)
+    collection_index = CollectionIndex(s3, bucket_name)
+
+    @staticmethod
+    def close_session(session_id: int) -> Optional[dict]:
+        session = AppContext.sessions.pop(session_id, None)
+        if session is None:
+            return None
+        session.close()
+        record = session.as_dict
+        record['participants'] = len(session.participants)
+        AppContext.archived_sessions[session_id] = record
+        while len(AppContext.archived_sessions) > AppContext.MAX_ARCHIVED_SESSIONS:
+            AppContext.archived_sessions.popitem(last=False)
+        return record
+
+    @staticmethod
+    def reload_collections(collections=None):
+        # Lista el bucket (solo las colecciones indicadas, si se indican)
+        AppContext.collections = AppContext.collection_index.refresh(collections)
+
+    @staticmethod
+    def load_collections():
+        # Si hay un índice guardado se usa mientras se vuelve a listar el bucket
+        if AppContext.collection_index.load():
+            AppContext.collections = AppContext.collection_index.collections
+            Thread(target=AppContext.reload_collections, daemon=True).start()
+        else:
+            AppContext.reload_collections()
+
+    @staticmethod
+    def index_logs():
+        # Indexa los logs que aún no están en el índice (p. ej. los anteriores al índice)
+        Thread(
+            target=AppContext.log_index.sync,
+            args=(SESSION_LOG_FOLDER, AppContext.post_session.is_pending),
+            daemon=True
+        ).start()
+
     @staticmethod
-    def reload_collections():
-        # Listar objetos en el bucket
-        response = AppContext.s3.list_objects_v2(Bucket=AppContext.bucket_name)
-
-        # Procesar objetos y construir el diccionario
-        for obj in response.get('Contents', []):
-            collection_name = obj['Key'].split('/')[0]
-            file_name = obj['Key'].split('/')[1]
-            
-            # Verificar si el nombre del objeto comienza con "Question"
-            if file_name.startswith('Question'):
-                # Obtén el conjunto de objetos para esta colección, o crea uno nuevo si no existe
-                questions = AppContext.collections.get(collection_name, set())
-                
-                # Agrega el nombre del objeto al conjunto
-                questions.add(file_name)
-                
-                # Actualiza el diccionario con el conjunto actualizado
-                AppContext.collections[collection_name] = questions
+    def collect_metrics():
+        # Leídas al generar /api/metrics, no en cada cambio
+        sessions = list(AppContext.sessions.values())
+        status_counts = {status: 0 for status in Session.Status}
+        for session in sessions:
+            status_counts[session.status] += 1
+        yield ('hans_sessions', 'gauge', "Open sessions by status",
+               [({'status': status.value}, count) for status, count in status_counts.items()])
+        yield ('hans_session_participants', 'gauge', "Participants of each open session",
+               [({'session_id': session.id}, len(session.participants)) for session in sessions])
+        yield ('hans_session_messages_total', 'counter', "MQTT messages received for each open session",
+               [({'session_id': session.id}, session.communicator.messages.total) for session in sessions])
+        yield ('hans_session_messages_per_second', 'gauge',
+               "MQTT messages per second received for each open session over the last seconds",
+               [({'session_id': session.id}, session.communicator.messages.rate) for session in sessions])
+
+        if AppContext.mqtt_router is not None:
+            publish = AppContext.mqtt_router.publish_stats
+            yield ('hans_mqtt_publish_queue_depth', 'gauge', "Messages waiting to be handed to the broker connection",
+                   [({}, publish['depth'])])
+            yield ('hans_mqtt_publish_in_flight', 'gauge', "Messages written and not yet confirmed by the broker",
+                   [({}, publish['in_flight'])])
+            yield ('hans_mqtt_publish_messages_total', 'counter', "Messages published by result",
+                   [({'result': result}, publish[result]) for result in ('published', 'failed', 'coalesced')])
+
+        cache = AppContext.question_cache.stats
+        lookups = cache['hits'] + cache['misses']
+        yield ('hans_question_cache_lookups_total', 'counter', "Question file lookups by result",
+               [({'result': 'hit'}, cache['hits']), ({'result': 'miss'}, cache['misses'])])
+        yield ('hans_question_cache_revalidations_total', 'counter', "Expired question files still valid in S3",
+               [({}, cache['revalidations'])])
+        yield ('hans_question_cache_hit_ratio', 'gauge', "Question file lookups served from memory",
+               [({}, cache['hits'] / lookups if lookups else 0.0)])
+        yield ('hans_question_cache_bytes', 'gauge', "Bytes of the question files in memory", [({}, cache['bytes'])])
+
+        jobs = list(AppContext.post_session.jobs.values())
+        yield ('hans_post_session_jobs_pending', 'gauge', "Post-session jobs queued or running",
+               [({}, sum(1 for job in jobs if job.pending))])
+
 
+AppContext.metrics.collector(AppContext.collect_metrics)
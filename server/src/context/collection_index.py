@@ -0,0 +1,92 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, Optional, Set
+
+QUESTION_PREFIX = 'Question'
+
+
+class CollectionIndex():
+    '''
+        Questions available in each collection of the S3 bucket. Listings are
+        paginated and done per collection prefix in parallel. S3 does not
+        tell which prefixes changed, so a refresh either lists every
+        collection or only the ones the caller names. The index can be saved
+        to disk so the server can start with it while the bucket is listed
+        again.
+    '''
+    def __init__(self, s3, bucket_name: str, workers: int = 8, path: Optional[Path] = None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.workers = workers
+        self.path = path
+        # Replaced as a whole on every refresh, so readers never see it changing
+        self.collections: Dict[str, Set[str]] = {}
+        self._lock = Lock()
+
+    def _list_prefix(self, prefix: str = ''):
+        """Yields the names directly under prefix, following continuation tokens"""
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                yield common_prefix['Prefix'][len(prefix):].rstrip('/')
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(prefix):]
+
+    def list_collections(self) -> Set[str]:
+        return {name for name in self._list_prefix() if name}
+
+    def list_questions(self, collection: str) -> Set[str]:
+        return {
+            name for name in self._list_prefix(f'{collection}/')
+            if name.startswith(QUESTION_PREFIX)
+        }
+
+    def refresh(self, collections: Optional[Iterable[str]] = None) -> Dict[str, Set[str]]:
+        """Lists the bucket again. When collections is given only those
+        prefixes are listed and the rest of the index is kept as it is: the
+        caller has to name every collection that changed, nothing else is
+        checked"""
+        if collections is None:
+            names = self.list_collections()
+        else:
+            names = set(collections)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            listed = dict(zip(names, executor.map(self.list_questions, names)))
+
+        with self._lock:
+            updated = {} if collections is None else dict(self.collections)
+            for name, questions in listed.items():
+                if questions:
+                    updated[name] = questions
+                else:
+                    updated.pop(name, None)
+            self.collections = updated
+        self.save()
+        return updated
+
+    def load(self) -> bool:
+        if self.path is None:
+            return False
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.collections = {name: set(questions) for name, questions in data.items()}
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + '.part')
+            with open(tmp_path, 'w') as f:
+                json.dump({name: sorted(questions) for name, questions in self.collections.items()}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"ERROR: Could not save the collection index to {self.path}: {e}")
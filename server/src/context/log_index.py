@@ -0,0 +1,157 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from typing import List, Optional, Tuple
+
+from .session_log import iter_binary_log
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS logs (
+    name TEXT PRIMARY KEY,
+    time TEXT,
+    session_id INTEGER,
+    collection TEXT,
+    question TEXT,
+    duration INTEGER,
+    participants INTEGER,
+    rows INTEGER,
+    log_bytes INTEGER,
+    zip_bytes INTEGER,
+    trajectory_bytes INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS logs_time ON logs (time);
+CREATE INDEX IF NOT EXISTS logs_question ON logs (collection, question);
+'''
+COLUMNS = ('name', 'time', 'session_id', 'collection', 'question', 'duration',
+           'participants', 'rows', 'log_bytes', 'zip_bytes', 'trajectory_bytes', 'error')
+MAX_PAGE_SIZE = 500
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def count_log_rows(log_folder: Path) -> int:
+    """Updates stored in the log of a session, read back from the files. Only
+    used for the logs written before the index existed"""
+    if (log_folder / 'log.bin').is_file():
+        return sum(len(ids) for ids, _, _, _ in iter_binary_log(log_folder / 'log.bin'))
+    if (log_folder / 'log.csv').is_file():
+        with open(log_folder / 'log.csv', 'rb') as f:
+            return sum(1 for line in f if line.strip())
+    return 0
+
+
+class LogIndex():
+    '''
+        SQLite table with one row per session log (the folders in
+        session_log), written when the post-session job of the log finishes.
+        The log queries of the API only read this table, never the folders.
+    '''
+    def __init__(self, path: Path = Path('tmp/log_index.sqlite')):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = Lock()
+        self._open_lock = Lock()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # Opened on first use, so the path can be set from the command line.
+        # Not under self._lock, which the callers already hold
+        if self._db is None:
+            with self._open_lock:
+                if self._db is None:
+                    Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                    db = sqlite3.connect(self.path, check_same_thread=False)
+                    db.row_factory = sqlite3.Row
+                    db.executescript(SCHEMA)
+                    # Index files created before the error column existed
+                    if 'error' not in {row['name'] for row in db.execute("PRAGMA table_info(logs)")}:
+                        db.execute("ALTER TABLE logs ADD COLUMN error TEXT")
+                    self._db = db
+        return self._db
+
+    @staticmethod
+    def describe(log_folder: Path, rows: Optional[int] = None, error: Optional[str] = None) -> dict:
+        """Row of the index for a log folder. rows is counted from the log
+        files when it is not given. error is set when the post-session job of
+        the log failed"""
+        log_folder = Path(log_folder)
+        try:
+            with open(log_folder / 'session.json') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            info = {}
+        participants = info.get('participants', [])
+        return {
+            'name': log_folder.name,
+            'time': info.get('time', None),
+            'session_id': info.get('id', None),
+            'collection': info.get('collection', None),
+            'question': str(info['question']) if info.get('question', None) is not None else None,
+            'duration': info.get('duration', None),
+            'participants': len(participants) if isinstance(participants, list) else 0,
+            'rows': count_log_rows(log_folder) if rows is None else rows,
+            'log_bytes': sum(_file_size(log_folder / name) for name in ('log.csv', 'log.bin')),
+            'zip_bytes': _file_size(log_folder.parent / 'zips' / f"{log_folder.name}.zip"),
+            'trajectory_bytes': _file_size(Path('trajectories') / f"{log_folder.name}.txt"),
+            'error': error,
+        }
+
+    def record(self, entry: dict):
+        with self._lock, self.db:
+            self.db.execute(
+                f"INSERT OR REPLACE INTO logs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [entry.get(column, None) for column in COLUMNS]
+            )
+
+    def remove(self, names: List[str]):
+        with self._lock, self.db:
+            self.db.executemany("DELETE FROM logs WHERE name = ?", [(name,) for name in names])
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.db.execute("SELECT name FROM logs ORDER BY name")]
+
+    def sync(self, log_root: Path, skip=lambda name: False):
+        """Adds the log folders that are not indexed yet and drops the entries
+        whose folder is gone. skip tells the folders still being written"""
+        log_root = Path(log_root)
+        folders = set()
+        if log_root.is_dir():
+            folders = {
+                entry.name for entry in os.scandir(log_root)
+                if entry.is_dir() and entry.name != 'zips' and not skip(entry.name)
+            }
+        indexed = set(self.names())
+        self.remove(sorted(indexed - folders))
+        for name in sorted(folders - indexed):
+            self.record(LogIndex.describe(log_root / name))
+
+    def query(self, collection: Optional[str] = None, question: Optional[str] = None,
+              session_id: Optional[int] = None, since: Optional[str] = None, until: Optional[str] = None,
+              limit: int = 50, offset: int = 0) -> Tuple[int, List[dict]]:
+        """(total matches, one page of them), newest first. since and until
+        compare with the ISO time of the session"""
+        conditions, params = [], []
+        for column, operator, value in (('collection', '=', collection), ('question', '=', question),
+                                        ('session_id', '=', session_id), ('time', '>=', since),
+                                        ('time', '<', until)):
+            if value is not None:
+                conditions.append(f"{column} {operator} ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        limit = max(0, min(limit, MAX_PAGE_SIZE))
+        with self._lock:
+            total = self.db.execute(f"SELECT COUNT(*) FROM logs {where}", params).fetchone()[0]
+            rows = self.db.execute(
+                f"SELECT * FROM logs {where} ORDER BY time DESC, name DESC LIMIT ? OFFSET ?",
+                params + [limit, max(0, offset)]
+            ).fetchall()
+        return total, [dict(row) for row in rows]
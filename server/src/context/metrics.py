@@ -0,0 +1,214 @@
+"""Counters and latency histograms of the hot paths, rendered in the Prometheus
+text format by /api/metrics.
+
+The metrics are updated without locks: every value is a plain attribute or a
+list slot incremented in place, and the labelled children are created once and
+kept by the code that updates them, so recording a message creates no objects
+besides the numbers themselves.
+Updates from several threads at the same instant may very rarely lose an
+increment; that is accepted to keep them off the hot paths.
+
+Values that already exist somewhere else (queue depths, cache stats, the
+sessions) are not copied on every change: collectors registered with
+REGISTRY.collector read them when the metrics are rendered.
+"""
+import math
+import time
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Seconds, from a few microseconds (an MQTT handler) to seconds (an S3 fetch)
+LATENCY_BUCKETS = (
+    0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# (name, type, help, [(labels, value)]) of a metric read by a collector
+Sample = Tuple[Dict[str, str], float]
+Family = Tuple[str, str, str, List[Sample]]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Counter():
+    '''
+        Monotonic count or sum. Its family is registered with the _total
+        name it is exposed with.
+    '''
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name: str, labels: Dict[str, str]) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        yield name, labels, self.value
+
+
+class Histogram():
+    '''
+        Observations counted in fixed buckets. The counts are kept per bucket
+        and only made cumulative when rendered.
+    '''
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name: str, labels: Dict[str, str]) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        counts = list(self.counts)
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            yield name + '_bucket', {**labels, 'le': _format_value(bound)}, cumulative
+        cumulative += counts[-1]
+        yield name + '_bucket', {**labels, 'le': '+Inf'}, cumulative
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, cumulative
+
+
+class RateMeter():
+    '''
+        Events per second over the last complete seconds, counted in a ring of
+        one slot per second so the rate does not depend on how often it is
+        read.
+    '''
+    def __init__(self, window: int = 5):
+        self.window = window
+        self.total = 0
+        self._seconds = [-1] * (window + 1)
+        self._counts = [0] * (window + 1)
+
+    def mark(self):
+        self.total += 1
+        second = int(time.monotonic())
+        slot = second % len(self._seconds)
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._counts[slot] = 0
+        self._counts[slot] += 1
+
+    @property
+    def rate(self) -> float:
+        current = int(time.monotonic())
+        return sum(
+            count for second, count in zip(self._seconds, self._counts)
+            if current - self.window <= second < current
+        ) / self.window
+
+
+class MetricFamily():
+    '''
+        A metric and its children, one per combination of label values.
+        labels() is meant to be called once and its result kept.
+    '''
+    def __init__(self, name: str, kind: str, help: str, label_names: Sequence[str], factory: Callable):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children: Dict[Tuple[str, ...], object] = {}
+        self._lock = Lock()
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key, None)
+        if child is None:
+            if len(key) != len(self.label_names):
+                raise ValueError(f"{self.name} has the labels {self.label_names}, got {key}")
+            with self._lock:
+                child = self.children.setdefault(key, self.factory())
+        return child
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for key, child in list(self.children.items()):
+            for name, labels, value in child.samples(self.name, dict(zip(self.label_names, key))):
+                yield f"{name}{_format_labels(labels)} {_format_value(value)}"
+
+
+class MetricsRegistry():
+    '''
+        Every metric shown by /api/metrics.
+    '''
+    def __init__(self):
+        self.families: Dict[str, MetricFamily] = {}
+        self.collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def _register(self, family: MetricFamily) -> MetricFamily:
+        if family.name in self.families:
+            raise ValueError(f"Metric {family.name} already registered")
+        self.families[family.name] = family
+        return family
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> MetricFamily:
+        if not name.endswith('_total'):
+            raise ValueError(f"Counter {name} must be named with the _total suffix")
+        return self._register(MetricFamily(name, 'counter', help, labels, Counter))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> MetricFamily:
+        return self._register(MetricFamily(name, 'histogram', help, labels, lambda: Histogram(buckets)))
+
+    def collector(self, collect: Callable[[], Iterable[Family]]):
+        """collect() returns the (name, type, help, samples) of metrics read
+        from elsewhere each time the metrics are rendered"""
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for family in list(self.families.values()):
+            lines.extend(family.render())
+        for collect in self.collectors:
+            try:
+                families = list(collect())
+            except Exception as e:
+                print(f"ERROR: Could not collect metrics: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = MetricsRegistry()
+
+MQTT_HANDLER_SECONDS = REGISTRY.histogram(
+    'hans_mqtt_handler_seconds', "Time spent handling the MQTT messages of the sessions", ('handler',))
+MQTT_HANDLER_ERRORS = REGISTRY.counter(
+    'hans_mqtt_handler_errors_total', "MQTT messages that could not be handled", ('handler',))
+LOG_BYTES = REGISTRY.counter(
+    'hans_log_bytes_written_total', "Bytes written to the session logs", ('sink',))
+LOG_ROWS = REGISTRY.counter(
+    'hans_log_rows_written_total', "Participant updates written to the session logs")
+S3_FETCH_SECONDS = REGISTRY.histogram(
+    'hans_s3_fetch_seconds', "Time spent fetching question files from S3", ('result',))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'hans_http_request_seconds', "Time spent serving the API requests, until the response is returned",
+    ('route', 'method', 'status'))
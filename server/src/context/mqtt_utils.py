@@ -1,11 +1,148 @@
 from abc import ABC, abstractmethod
-from threading import Thread
-from typing import Callable, Dict
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+from typing import Callable, Deque, Dict, List, Set
 
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CONNACK_ACCEPTED, MQTT_ERR_SUCCESS
 
 
+class PublishQueue:
+    '''
+        Outbound messages waiting to be handed to paho. A single worker drains
+        the queue in batches, so publishing never spawns a thread. Messages
+        published with coalesce=True replace a message for the same topic that
+        is still waiting instead of being queued again.
+    '''
+    class Message:
+        def __init__(self, topic: str, payload, coalesce: bool):
+            self.topic = topic
+            self.payload = payload
+            self.coalesce = coalesce
+            self.futures: List[Future] = []
+
+    def __init__(self, client: mqtt.Client):
+        self.client = client
+        self._cond = Condition()
+        self._pending: Deque[PublishQueue.Message] = deque()
+        self._coalescible: Dict[str, PublishQueue.Message] = {}
+        self._in_flight: Dict[int, List[Future]] = {}
+        self._early_acks: Set[int] = set()
+        self._worker: Thread = None
+        self._running = False
+
+        self.published = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'in_flight': len(self._in_flight),
+            'published': self.published,
+            'failed': self.failed,
+            'coalesced': self.coalesced,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._worker = Thread(target=self._run, name='mqtt-publish', daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        with self._cond:
+            pending, self._pending = self._pending, deque()
+            self._coalescible.clear()
+        for message in pending:
+            self._resolve(message.futures, False)
+        self.fail_in_flight()
+
+    def put(self, topic: str, payload, coalesce=False) -> Future:
+        future = Future()
+        with self._cond:
+            message = self._coalescible.get(topic, None) if coalesce else None
+            if message is not None:
+                message.payload = payload
+                self.coalesced += 1
+            else:
+                message = PublishQueue.Message(topic, payload, coalesce)
+                self._pending.append(message)
+                if coalesce:
+                    self._coalescible[topic] = message
+                self._cond.notify()
+            message.futures.append(future)
+        return future
+
+    def acknowledge(self, message_id: int):
+        with self._cond:
+            futures = self._in_flight.pop(message_id, None)
+            if futures is None:
+                # paho may report the publication before the worker registers it
+                self._early_acks.add(message_id)
+                return
+        self._resolve(futures, True)
+
+    def fail_in_flight(self):
+        with self._cond:
+            in_flight, self._in_flight = self._in_flight, {}
+            self._early_acks.clear()
+        for futures in in_flight.values():
+            self._resolve(futures, False)
+
+    def _resolve(self, futures: List[Future], success: bool):
+        with self._cond:
+            if success:
+                self.published += len(futures)
+            else:
+                self.failed += len(futures)
+        for future in futures:
+            future.set_result(success)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                batch, self._pending = self._pending, deque()
+                self._coalescible.clear()
+
+            for message in batch:
+                try:
+                    info = self.client.publish(message.topic, message.payload)
+                except Exception as e:
+                    print(f"ERROR: Could not publish message on topic {message.topic}: {e}")
+                    self._resolve(message.futures, False)
+                    continue
+                if info.rc != MQTT_ERR_SUCCESS:
+                    self._resolve(message.futures, False)
+                    continue
+                with self._cond:
+                    acknowledged = info.mid in self._early_acks
+                    if acknowledged:
+                        self._early_acks.discard(info.mid)
+                    else:
+                        self._in_flight[info.mid] = message.futures
+                if acknowledged:
+                    self._resolve(message.futures, True)
+
+
 class MQTTClient(ABC):
     @abstractmethod
     def connection_handler(self, connected: bool, reason: int) -> None: ...
@@ -19,13 +156,21 @@ class MQTTClient(ABC):
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_subscribe = self.on_subscribe
+        self.client.on_publish = self.on_publish
         self.client.ws_set_options(path="/")
+        self.publish_queue = PublishQueue(self.client)
+
+    @property
+    def publish_stats(self) -> dict:
+        return self.publish_queue.stats
 
     def start(self):
+        self.publish_queue.start()
         self.client.connect_async(self.host, self.port, 60)
         self.client.loop_start()
 
     def shutdown(self):
+        self.publish_queue.stop()
         self.client.loop_stop()
 
     def on_connect(self, client, obj, flags, rc):
@@ -34,12 +179,17 @@ class MQTTClient(ABC):
 
     def on_disconnect(self, client, obj, rc):
         self.connected = False
+        # Messages written to a dropped connection will never be confirmed
+        self.publish_queue.fail_in_flight()
         self.connection_handler(False, rc)
 
     def on_subscribe(self, client, obj, message_id, granted_qos):
         if message_id not in self.pending_subscriptions:
             return
-        self.pending_subscriptions[message_id](True)
+        self.pending_subscriptions.pop(message_id)(True)
+
+    def on_publish(self, client, obj, message_id):
+        self.publish_queue.acknowledge(message_id)
 
     def subscribe(self, topic, callback: Callable[[bool], None] = None):
         result, message_id = self.client.subscribe(topic)
@@ -49,14 +199,14 @@ class MQTTClient(ABC):
             else:
                 callback(False)
 
-    def publish_sync(self, topic, msg, callback: Callable[[bool], None] = None):
-        msg_handle = self.client.publish(topic, msg)
-        msg_handle.wait_for_publish()
-        if callback: callback(True) # TODO: Send false if message could not be queued
-
-    def publish(self, topic, msg, post_callback=None):
-        Thread(
-            target=self.publish_sync,
-            args=(topic, msg, post_callback),
-            daemon=True
-        ).start()
+    def publish_sync(self, topic, msg, callback: Callable[[bool], None] = None) -> bool:
+        # Blocks until the message is written: never call it from the network thread
+        success = self.publish_queue.put(topic, msg).result()
+        if callback: callback(success)
+        return success
+
+    def publish(self, topic, msg, post_callback: Callable[[bool], None] = None, coalesce=False) -> Future:
+        future = self.publish_queue.put(topic, msg, coalesce)
+        if post_callback:
+            future.add_done_callback(lambda f: post_callback(f.result()))
+        return future
@@ -1,8 +1,13 @@
 from enum import Enum
+from itertools import count
+from typing import Callable, Optional
 
 
 class Participant():
-    last_id = 0
+    # Large sessions hold thousands of participants: no per-instance __dict__
+    __slots__ = ('id', 'username', '_status', '_as_dict', 'on_status_changed')
+
+    _ids = count(1)
 
     class Status(Enum):
         JOINED = 'joined'
@@ -11,10 +16,12 @@ class Participant():
         OFFLINE = 'offline'
 
     def __init__(self, username):
-        Participant.last_id += 1
-        self.id = Participant.last_id
+        self.id = next(Participant._ids)
         self.username = username
         self._status = Participant.Status.JOINED
+        self._as_dict: Optional[dict] = None
+        # Called with (participant, old_status, new_status) when the status changes
+        self.on_status_changed: Callable[['Participant', 'Participant.Status', 'Participant.Status'], None] = None
 
     @property
     def status(self):
@@ -23,12 +30,18 @@ class Participant():
     @status.setter
     def status(self, status):
         if status != self._status:
-            self._status = status
+            old_status, self._status = self._status, status
+            self._as_dict = None
+            if self.on_status_changed:
+                self.on_status_changed(self, old_status, status)
 
     @property
     def as_dict(self):
-        return {
-            'id': self.id,
-            'username': self.username,
-            'status': self._status.value,
-        }
+        # Cached until the status changes; it must not be modified by the callers
+        if self._as_dict is None:
+            self._as_dict = {
+                'id': self.id,
+                'username': self.username,
+                'status': self._status.value,
+            }
+        return self._as_dict
@@ -2,38 +2,101 @@ from __future__ import annotations
 import datetime
 import os
 import csv
-from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-import dateutil.parser
 import numpy as np
 
 RADIUS = 340
+EPOCH = datetime.datetime(1970, 1, 1)
+TRAJECTORY_CHUNK_ROWS = 8192
+
+def _days_from_civil(year: int, month: int, day: int) -> int:
+    # Days since 1970-01-01 for a proleptic Gregorian date (H. Hinnant's algorithm)
+    year -= month <= 2
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def iso_to_epoch_ms(value) -> int:
+    """Parses the timestamps sent by the clients into milliseconds since the
+    epoch. The 'YYYY-MM-DDTHH:MM:SS.mmmZ' format produced by the browsers is
+    parsed by slicing; anything else goes through datetime.fromisoformat"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if len(value) == 24 and value[23] == 'Z' and value[10] == 'T':
+        days = _days_from_civil(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+        return (
+            ((days * 24 + int(value[11:13])) * 60 + int(value[14:16])) * 60000
+            + int(value[17:19]) * 1000 + int(value[20:23])
+        )
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (parsed - EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+def epoch_ms_to_iso(timestamp_ms: int) -> str:
+    return (EPOCH + datetime.timedelta(milliseconds=int(timestamp_ms))).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def normalize_positions(positions: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Normalizes a batch of encoded positions, one per row: negative weights
+    are clamped to 0 and rows whose weights add up to more than 1 are divided
+    by their sum. Rows shorter than the batch must be padded with zeros"""
+    positions = np.maximum(positions, 0, out=out)
+    sums = positions.sum(axis=1, keepdims=True)
+    np.divide(positions, sums, out=positions, where=sums > 1)
+    return positions
+
 class PositionCodec:
     """Useful to transform the position from and to the format which the
     server requires"""
     
     def __init__(self, answer_points: np.ndarray):
         self.answer_points = answer_points
+        num_answers = answer_points.shape[0]
+        if num_answers >= 3:
+            # The answers are placed around a circle, so the two answers closest to a
+            # point are the ones at both sides of its angle. Sector i goes from answer
+            # i to answer i + 1; its basis is inverted once here instead of solving a
+            # system for every point
+            angles = np.arctan2(answer_points[:, 1], answer_points[:, 0])
+            self._start_angle = angles[0]
+            self._sector_angles = np.mod(angles - angles[0], 2 * np.pi)
+            self._sectors = np.stack((np.arange(num_answers), (np.arange(num_answers) + 1) % num_answers), axis=1)
+            self._inverse_bases = np.linalg.inv(
+                np.stack((answer_points, answer_points[self._sectors[:, 1]]), axis=2)
+            )
     
     def distance_squared(self, v1: np.ndarray, v2: np.ndarray, axis: int = -1):
         return ((v1 - v2) ** 2).sum(axis=axis)
 
     def distance(self, v1: np.ndarray, v2: np.ndarray, axis: int = -1) -> np.ndarray:
-        return np.sqrt(distance_squared(v1, v2, axis))
+        return np.sqrt(self.distance_squared(v1, v2, axis))
 
     def encode(self, point: np.ndarray) -> np.ndarray:
         """Transforms the (2, ) numpy array into another numpy array in the format
         required by the hans platform"""
-
-        distance_to_answers = distance(self.answer_points, point)
-        closest_indices = np.argsort(distance_to_answers)[:2]
-        new_basis = self.answer_points[closest_indices]
-        point_new_basis = np.linalg.solve(new_basis.T, point)
-
-        encoded_position = np.zeros(self.answer_points.shape[0])
-        encoded_position[closest_indices] = point_new_basis
-
-        return encoded_position
+        return self.encode_many(np.asarray(point, dtype=float).reshape(1, 2))[0]
+
+    def encode_many(self, points: np.ndarray) -> np.ndarray:
+        """Encodes a (N, 2) array of points into a (N, num_answers) array"""
+        num_answers = self.answer_points.shape[0]
+        if num_answers < 3:
+            raise ValueError("Positions can only be encoded with 3 or more answers")
+        points = np.asarray(points, dtype=float)
+        relative_angles = np.mod(np.arctan2(points[:, 1], points[:, 0]) - self._start_angle, 2 * np.pi)
+        sectors = np.searchsorted(self._sector_angles, relative_angles, side='right') - 1
+        # (N, 2, 2) @ (N, 2): the point in the basis of the two answers of its sector
+        weights = np.einsum('nij,nj->ni', self._inverse_bases[sectors], points)
+
+        encoded_positions = np.zeros((len(points), num_answers))
+        rows = np.arange(len(points))[:, None]
+        encoded_positions[rows, self._sectors[sectors]] = weights
+        return encoded_positions
 
     def decode(self, encoded_position: np.ndarray) -> np.ndarray:
         """Decodes the format sent by the hans platform"""
@@ -44,72 +107,93 @@ class PositionCodec:
 
         return self.answer_points.T @ encoded_position
 
-@dataclass
-class PositionRecord:
-    participant_id: int
-    timestamp: datetime.datetime
-    position: np.ndarray
-
-    @classmethod
-    def from_csv_row(cls, csv_row, pcodec):
-        encoded_positions = list(map(float, csv_row[2:]))
-        if len(encoded_positions) != pcodec.answer_points.shape[0]:
-            print(encoded_positions)
-            print(f"Encoded positions size: {len(encoded_positions)}, Answer points size: {pcodec.answer_points.shape[0]}")
-        return cls(
-            int(csv_row[0]),
-            dateutil.parser.parse(csv_row[1]),
-            pcodec.decode(np.array(encoded_positions)),
-        )
-
-
-@dataclass
-class TrajectoryPoint:
-    # Normalized vector so that, in case the radius is changed, the trajectory
-    # of the data is still useful
-    norm_position: np.ndarray
-
-    # elapsed seconds since the first position
-    timestamp: float
-
-    def to_csv_row(self):
-        x, y = self.norm_position
-        return f"{self.timestamp},{x},{y}"
-
-def _last_part(path):
-        return os.path.basename(os.path.normpath(path))
-
-def transform_to_trajectory_points(records, radius):
-    if len(records) == 0:
-        return []
-
-    offset = records[0].timestamp
-    trajectory_points = [
-        TrajectoryPoint(
-            norm_position=record.position / radius,
-            timestamp=(record.timestamp - offset).total_seconds(),
-        )
-        for record in records
-    ]
-
-    return trajectory_points
-
-
-def create_trajectory_file(path, target_path, pcodec, filename):
+    def decode_many(self, encoded_positions: np.ndarray) -> np.ndarray:
+        """Decodes a (N, num_answers) array into a (N, 2) array of points"""
+        if encoded_positions.shape[1] != self.answer_points.shape[0]:
+            print(f"Encoded positions size: {encoded_positions.shape[1]}, Answer points size: {self.answer_points.shape[0]}")
+            raise ValueError("Mismatch in the size of encoded_position and answer_points")
+        return encoded_positions @ self.answer_points
+
+
+@lru_cache(maxsize=32)
+def position_codec(num_answers: int, radius: float = RADIUS) -> PositionCodec:
+    """Shared codec for a number of answers, built once"""
+    return PositionCodec(calculate_answer_points(num_answers, radius))
+
+
+def _iter_log_chunks(log_path, chunk_rows):
+    """Yields the participant rows of a log.csv in lists of at most chunk_rows"""
+    with open(log_path, newline='') as f:
+        chunk = []
+        for row in csv.reader(f):
+            if not row or row[0] == "0":
+                continue
+            chunk.append(row)
+            if len(chunk) == chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _iter_log_arrays(log_directory, chunk_rows):
+    """Yields (timestamps in epoch ms, encoded positions) of the updates of a
+    session log in chunks, read from log.csv or, for the logs written with
+    --log-format binary, one block of log.bin at a time"""
+    csv_path = os.path.join(log_directory, "log.csv")
+    if os.path.isfile(csv_path):
+        for rows in _iter_log_chunks(csv_path, chunk_rows):
+            timestamps = np.fromiter(
+                (iso_to_epoch_ms(row[1]) for row in rows), dtype=np.int64, count=len(rows)
+            )
+            yield timestamps, np.array([row[2:] for row in rows], dtype=float)
+    else:
+        # Imported here: session_log imports this module
+        from .session_log import iter_binary_log
+        for _, timestamps, _, positions in iter_binary_log(os.path.join(log_directory, "log.bin")):
+            yield timestamps, positions.astype(float)
+
+
+def create_trajectory_file(path, target_path, pcodec, filename, chunk_rows=TRAJECTORY_CHUNK_ROWS):
+    """Converts the log of a session into a trajectory file chunk by chunk,
+    so the memory used does not depend on the length of the log"""
     filename += ".txt"
-
-    with open(os.path.join(path, "log.csv")) as f:
-        reader = csv.reader(f)
-        records = [
-            PositionRecord.from_csv_row(row, pcodec) for row in reader if row[0] != "0"
-        ]
-    trajectory_points = transform_to_trajectory_points(records, RADIUS)
-    trajectory_rows = [trajectory_point.to_csv_row() for trajectory_point in trajectory_points]
-
-    with open(os.path.join(target_path, filename), "w") as f:
+    # Hidden until it is complete: the zips skip dotfiles, and the log folder
+    # is left untouched if the conversion fails
+    tmp_path = os.path.join(target_path, "." + filename + ".part")
+
+    try:
+        _write_trajectory_file(tmp_path, path, pcodec, chunk_rows)
+        os.replace(tmp_path, os.path.join(target_path, filename))
+    finally:
+        # Only left if the conversion failed
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _write_trajectory_file(tmp_path, path, pcodec, chunk_rows):
+    offset = None
+    with open(tmp_path, "w") as f:
         # TODO: change this hardcoded value
         f.write("0\n\n")
-        f.writelines([f"{trajectory_row}\n" for trajectory_row in trajectory_rows])
+        num_answers = pcodec.answer_points.shape[0]
+        for timestamps, encoded_positions in _iter_log_arrays(path, chunk_rows):
+            if encoded_positions.shape[1] != num_answers:
+                # log.bin blocks are as wide as their widest row, padded with zeros
+                padded = np.zeros((len(encoded_positions), num_answers))
+                width = min(num_answers, encoded_positions.shape[1])
+                padded[:, :width] = encoded_positions[:, :width]
+                encoded_positions = padded
+            if offset is None:
+                offset = timestamps[0]
+
+            # All the positions of the chunk decoded at once
+            norm_positions = pcodec.decode_many(encoded_positions) / RADIUS
+            seconds = (timestamps - offset) / 1000
+            f.writelines(
+                f"{timestamp},{x},{y}\n"
+                for timestamp, (x, y) in zip(seconds.tolist(), norm_positions.tolist())
+            )
 
 def calculate_answer_points(num_answers: int, radius: float):
     # Keep in mind that the basis vector for the y axis points downwards. Therefore,
@@ -124,9 +208,23 @@ def calculate_answer_points(num_answers: int, radius: float):
         return np.trunc(
             radius * np.stack((np.cos(angles), np.sin(angles)), axis=1)
         )
+def log_num_answers(log_directory, default: int = 6) -> int:
+    """Number of answers of a session, read from the first update of its
+    log.csv or log.bin"""
+    csv_path = os.path.join(log_directory, "log.csv")
+    if os.path.isfile(csv_path):
+        for rows in _iter_log_chunks(csv_path, 1):
+            return len(rows[0]) - 2
+        return default
+    from .session_log import iter_binary_log
+    for _, _, widths, _ in iter_binary_log(os.path.join(log_directory, "log.bin")):
+        if len(widths):
+            return int(widths[0])
+    return default
+
 def convert_trajectory_files(log_directory):
 
-    pcodec = PositionCodec(calculate_answer_points(num_answers=6, radius=RADIUS))
+    pcodec = position_codec(log_num_answers(log_directory))
     timestamp = os.path.basename(log_directory)
     target_path = Path('trajectories')
     create_trajectory_file(os.path.join(log_directory), target_path, pcodec, timestamp)
\ No newline at end of file
@@ -0,0 +1,197 @@
+import json
+import os
+import queue
+import time
+import traceback
+import zipfile
+from collections import OrderedDict
+from datetime import datetime
+from enum import Enum
+from itertools import count
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+import src.context as ctx
+from .log_index import LogIndex
+from .position_format_utils import convert_trajectory_files
+from .session_log import SessionLogWriter
+
+
+class PostSessionJob():
+    '''
+        Everything that has to happen once a session stops: flush the log,
+        complete session.json, write resume.csv, convert the trajectories and
+        build the zip. The steps run in order on a pipeline worker.
+    '''
+    _ids = count(1)
+
+    class Status(Enum):
+        QUEUED = 'queued'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    def __init__(self, session_id: int, log_folder: Path, log_writer: Optional[SessionLogWriter],
+                 participants: List[dict], answers: Dict[int, Tuple[int, List[float]]], trajectories: bool):
+        self.id = next(PostSessionJob._ids)
+        self.session_id = session_id
+        self.log_folder = log_folder
+        self.log_writer = log_writer
+        self.participants = participants
+        self.answers = answers
+        self.trajectories = trajectories
+        self.status = PostSessionJob.Status.QUEUED
+        self.error: Optional[str] = None
+        self.created = datetime.now()
+        self.started: Optional[datetime] = None
+        self.finished: Optional[datetime] = None
+
+    @property
+    def log_name(self) -> str:
+        return self.log_folder.name
+
+    @property
+    def pending(self) -> bool:
+        return self.status in (PostSessionJob.Status.QUEUED, PostSessionJob.Status.RUNNING)
+
+    @property
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'session_id': self.session_id,
+            'log': self.log_name,
+            'status': self.status.value,
+            'error': self.error,
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+        }
+
+    def run(self):
+        rows = None
+        error = None
+        try:
+            if self.log_writer:
+                if not self.log_writer.close():
+                    # The blocks still queued would be missing from the zip
+                    raise RuntimeError("The session log could not be closed")
+                rows = self.log_writer.rows
+                self.log_writer = None
+
+            with open(self.log_folder / 'session.json', 'r+') as file:
+                data = json.load(file)
+                data['participants'] = self.participants
+                file.seek(0)
+                json.dump(data, file, indent=4)
+                file.truncate()
+
+            for storage in ctx.AppContext.storages:
+                storage.save_answers(self.log_folder, self.answers)
+
+            if self.trajectories:
+                convert_trajectory_files(self.log_folder)
+            self.generate_zip()
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            # Also when the job fails, or the log would be missing from the
+            # index (and /api/listLogs) until the folders are synced again
+            try:
+                ctx.AppContext.log_index.record(LogIndex.describe(self.log_folder, rows, error))
+            except Exception as e:
+                print(f"ERROR: Could not index session log {self.log_name}: {e}")
+
+    def generate_zip(self):
+        zip_folder = ctx.SESSION_LOG_FOLDER / 'zips'
+        zip_folder.mkdir(parents=True, exist_ok=True)
+        zip_path = zip_folder / f"{self.log_name}.zip"
+        # Written under a temporary name so downloads never see a partial archive
+        tmp_path = zip_folder / f".{self.log_name}.zip.part"
+        with zipfile.ZipFile(tmp_path, "w") as zipf:
+            for root, _, files in os.walk(self.log_folder):
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    zipf.write(file_path, os.path.relpath(file_path, self.log_folder))
+        os.replace(tmp_path, zip_path)
+
+
+class PostSessionPipeline():
+    '''
+        Worker pool that runs the PostSessionJobs off the MQTT network thread.
+        Each job runs its steps in order, so its artifacts are complete once
+        the job is done.
+    '''
+    MAX_JOBS_KEPT = 1000
+
+    def __init__(self, workers: int = 2):
+        self.workers = workers
+        self.queue: queue.Queue = queue.Queue()
+        self.jobs: 'OrderedDict[int, PostSessionJob]' = OrderedDict()
+        self.jobs_by_log: Dict[str, PostSessionJob] = {}
+        self.lock = Lock()
+        self.threads: List[Thread] = []
+        self.closed = False
+
+    def submit(self, job: PostSessionJob) -> PostSessionJob:
+        with self.lock:
+            if self.closed:
+                print(f"ERROR: Post-session job of {job.log_name} submitted after shutdown")
+                job.error = "The server is shutting down"
+                job.status = PostSessionJob.Status.FAILED
+                return job
+            self.jobs[job.id] = job
+            self.jobs_by_log[job.log_name] = job
+            while len(self.jobs) > PostSessionPipeline.MAX_JOBS_KEPT:
+                _, old_job = self.jobs.popitem(last=False)
+                if self.jobs_by_log.get(old_job.log_name) is old_job:
+                    del self.jobs_by_log[old_job.log_name]
+            if not self.threads:
+                for i in range(max(1, self.workers)):
+                    thread = Thread(target=self._run, name=f'post-session-{i}', daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id: int) -> Optional[PostSessionJob]:
+        return self.jobs.get(job_id, None)
+
+    def is_pending(self, log_name: str) -> bool:
+        job = self.jobs_by_log.get(log_name, None)
+        return job is not None and job.pending
+
+    def shutdown(self, timeout: Optional[float] = None) -> bool:
+        """Stops taking jobs and waits for the queued ones to finish. Returns
+        False if some did not finish within the timeout"""
+        with self.lock:
+            self.closed = True
+            threads = list(self.threads)
+        # One stop mark per worker, behind the queued jobs
+        for _ in threads:
+            self.queue.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        pending = [job for job in list(self.jobs.values()) if job.pending]
+        for job in pending:
+            print(f"ERROR: Post-session job {job.id} of {job.log_name} not finished at shutdown")
+        return not pending
+
+    def _run(self):
+        while True:
+            job: Optional[PostSessionJob] = self.queue.get()
+            if job is None:
+                return
+            job.status = PostSessionJob.Status.RUNNING
+            job.started = datetime.now()
+            try:
+                job.run()
+                job.status = PostSessionJob.Status.DONE
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                job.status = PostSessionJob.Status.FAILED
+            finally:
+                job.finished = datetime.now()
@@ -0,0 +1,227 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, Optional, Set
+
+from botocore.exceptions import ClientError
+
+from .metrics import S3_FETCH_SECONDS
+
+CONTENT_TYPES = {
+    '.json': 'application/json',
+    '.png': 'image/png',
+}
+
+
+class CachedAsset():
+    def __init__(self, key: str, body: bytes, etag: str, content_type: str):
+        self.key = key
+        self.body = body
+        self.etag = etag
+        self.content_type = content_type
+        # Last time S3 confirmed this is the current version
+        self.checked = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+
+class QuestionAssetCache():
+    '''
+        Cache of the question files (info.json, img.png) stored in S3. Entries
+        are kept in an LRU bounded by their total size, optionally mirrored on
+        disk, and revalidated against S3 with their ETag once they are older
+        than the TTL. Concurrent misses for the same key share a single fetch.
+        Pinned keys (the questions sessions are about to show) are never
+        evicted.
+    '''
+    def __init__(self, s3, bucket_name: str, max_bytes: int = 64 * 1024 * 1024,
+                 ttl: float = 60.0, disk_dir: Optional[Path] = None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries: 'OrderedDict[str, CachedAsset]' = OrderedDict()
+        self._in_flight: Dict[str, Future] = {}
+        self._pins: Dict[str, int] = {}
+        # Pinned keys to revalidate on their next get
+        self._stale: Set[str] = set()
+        self._prefetcher: Optional[ThreadPoolExecutor] = None
+        self._lock = Lock()
+
+    @staticmethod
+    def question_key(collection: str, question_id: str, filename: str) -> str:
+        return f'{collection}/{question_id}/{filename}'
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'pinned': len(self._pins),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+        }
+
+    def get(self, key: str) -> CachedAsset:
+        with self._lock:
+            entry = self._entries.get(key, None)
+            # Pinned files are revalidated once when pinned and then served
+            # from memory until unpinned, whatever the TTL
+            if entry is not None and key not in self._stale and (
+                    key in self._pins or time.monotonic() - entry.checked < self.ttl):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            future = self._in_flight.get(key, None)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+                self.misses += 1
+
+        if not owner:
+            return future.result()
+        try:
+            entry = self._fetch(key, entry)
+            future.set_result(entry)
+            return entry
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def pin(self, keys: Iterable[str]):
+        with self._lock:
+            for key in keys:
+                if key not in self._pins and key in self._entries:
+                    self._stale.add(key)
+                self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, keys: Iterable[str]):
+        with self._lock:
+            for key in keys:
+                count = self._pins.get(key, 0) - 1
+                if count > 0:
+                    self._pins[key] = count
+                else:
+                    self._pins.pop(key, None)
+                    self._stale.discard(key)
+            self._evict()
+
+    def prefetch(self, keys: Iterable[str]):
+        """Loads the keys in the background so the first request is a hit"""
+        with self._lock:
+            if self._prefetcher is None:
+                self._prefetcher = ThreadPoolExecutor(max_workers=4, thread_name_prefix='question-prefetch')
+        for key in keys:
+            self._prefetcher.submit(self._prefetch_one, key)
+
+    def _prefetch_one(self, key: str):
+        try:
+            self.get(key)
+        except Exception as e:
+            print(f"No se pudo precargar el objeto {key}: {str(e)}")
+
+    def invalidate(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def _fetch(self, key: str, entry: Optional[CachedAsset]) -> CachedAsset:
+        if entry is None:
+            entry = self._load_from_disk(key)
+        request = {'Bucket': self.bucket_name, 'Key': key}
+        if entry is not None:
+            request['IfNoneMatch'] = entry.etag
+        start = time.perf_counter()
+        try:
+            response = self.s3.get_object(**request)
+            body = response['Body'].read()
+        except ClientError as e:
+            not_modified = entry is not None and e.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+            S3_FETCH_SECONDS.labels('not_modified' if not_modified else 'error').observe(time.perf_counter() - start)
+            if not_modified:
+                entry.checked = time.monotonic()
+                self.revalidations += 1
+                self._store(entry)
+                return entry
+            raise
+        except Exception:
+            S3_FETCH_SECONDS.labels('error').observe(time.perf_counter() - start)
+            raise
+        S3_FETCH_SECONDS.labels('ok').observe(time.perf_counter() - start)
+
+        entry = CachedAsset(
+            key,
+            body,
+            response['ETag'],
+            CONTENT_TYPES.get(Path(key).suffix, response.get('ContentType', 'application/octet-stream')),
+        )
+        self._store(entry)
+        self._save_to_disk(entry)
+        return entry
+
+    def _store(self, entry: CachedAsset):
+        with self._lock:
+            self._stale.discard(entry.key)
+            previous = self._entries.pop(entry.key, None)
+            if previous is not None:
+                self.size -= previous.size
+            if entry.size > self.max_bytes and entry.key not in self._pins:
+                return
+            self._entries[entry.key] = entry
+            self.size += entry.size
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held. Pinned entries may keep the cache over its limit
+        if self.size <= self.max_bytes:
+            return
+        for key in list(self._entries):
+            if self.size <= self.max_bytes:
+                break
+            if key in self._pins:
+                continue
+            self.size -= self._entries.pop(key).size
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / hashlib.sha1(key.encode()).hexdigest()
+
+    def _load_from_disk(self, key: str) -> Optional[CachedAsset]:
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path.with_suffix('.json')) as f:
+                meta = json.load(f)
+            body = path.read_bytes()
+        except (OSError, ValueError):
+            return None
+        # Revalidated by _fetch before it is served
+        return CachedAsset(key, body, meta['etag'], meta['content_type'])
+
+    def _save_to_disk(self, entry: CachedAsset):
+        if self.disk_dir is None:
+            return
+        try:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            path = self._disk_path(entry.key)
+            path.write_bytes(entry.body)
+            with open(path.with_suffix('.json'), 'w') as f:
+                json.dump({'key': entry.key, 'etag': entry.etag, 'content_type': entry.content_type}, f)
+        except OSError as e:
+            print(f"ERROR: Could not write {entry.key} to the question cache: {e}")
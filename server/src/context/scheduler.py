@@ -0,0 +1,154 @@
+import heapq
+import time
+import traceback
+from itertools import count
+from threading import Condition, Lock, Thread
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+
+class ScheduledTask():
+    __slots__ = ('callback', 'interval', 'cancelled')
+
+    def __init__(self, callback: Callable[[], None], interval: Optional[float]):
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler():
+    '''
+        Runs the timed tasks of every session from a single thread. Tasks are
+        kept in a heap ordered by due time, so thousands of them cost one
+        thread. Callbacks must be short: they delay every other task.
+    '''
+    def __init__(self):
+        self._heap: List[Tuple[float, int, ScheduledTask]] = []
+        self._seq = count()
+        self._cond = Condition()
+        self._thread: Optional[Thread] = None
+
+    def call_at(self, when: float, callback: Callable[[], None], interval: Optional[float] = None) -> ScheduledTask:
+        """Runs callback at the time.monotonic() value when"""
+        task = ScheduledTask(callback, interval)
+        self._push(when, task)
+        return task
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> ScheduledTask:
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def call_every(self, interval: float, callback: Callable[[], None]) -> ScheduledTask:
+        return self.call_at(time.monotonic() + interval, callback, interval)
+
+    def _push(self, when: float, task: ScheduledTask):
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._seq), task))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='scheduler', daemon=True)
+                self._thread.start()
+            elif self._heap[0][2] is task:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    when, _, task = self._heap[0]
+                    delay = when - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        break
+                    self._cond.wait(delay)
+
+            if task.cancelled:
+                continue
+            try:
+                task.callback()
+            except Exception:
+                traceback.print_exc()
+            if task.interval is not None and not task.cancelled:
+                # Keep the period, but do not try to catch up after a long callback
+                self._push(max(when + task.interval, time.monotonic()), task)
+
+
+class TimerWheel():
+    '''
+        Hashed timer wheel for many timeouts that keep being pushed back, such
+        as the keep-alives of every participant of every session. Touching a
+        key only records when it was last seen; keys are re-filed lazily when
+        their slot comes up, so heartbeats never reorder anything.
+    '''
+    def __init__(self, scheduler: Scheduler, resolution: float = 1.0, slots: int = 64):
+        self.scheduler = scheduler
+        self.resolution = resolution
+        self._slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._timeouts: Dict[Hashable, Tuple[float, Callable[[], None]]] = {}
+        self._last_seen: Dict[Hashable, float] = {}
+        self._tick_count = int(time.monotonic() / resolution)
+        self._lock = Lock()
+        self._task: Optional[ScheduledTask] = None
+
+    def __len__(self):
+        return len(self._timeouts)
+
+    def watch(self, key: Hashable, timeout: float, on_expire: Callable[[], None]):
+        """Calls on_expire if key is not touched for timeout seconds"""
+        now = time.monotonic()
+        with self._lock:
+            self._timeouts[key] = (timeout, on_expire)
+            self._last_seen[key] = now
+            self._file(key, now + timeout)
+            if self._task is None:
+                self._tick_count = int(now / self.resolution)
+                self._task = self.scheduler.call_every(self.resolution, self._tick)
+
+    def touch(self, key: Hashable):
+        if key in self._timeouts:
+            self._last_seen[key] = time.monotonic()
+
+    def unwatch(self, key: Hashable):
+        with self._lock:
+            # Its slot entry is dropped when the slot comes up
+            self._timeouts.pop(key, None)
+            self._last_seen.pop(key, None)
+
+    def _file(self, key: Hashable, deadline: float):
+        # Called with the lock held. Deadlines beyond one turn of the wheel are
+        # checked early and filed again
+        tick = max(int(deadline / self.resolution), self._tick_count + 1)
+        self._slots[tick % len(self._slots)].add(key)
+
+    def _tick(self):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            current = int(now / self.resolution)
+            # After a long stall going once around the wheel visits every key
+            self._tick_count = max(self._tick_count, current - len(self._slots))
+            while self._tick_count < current:
+                self._tick_count += 1
+                slot = self._slots[self._tick_count % len(self._slots)]
+                keys = list(slot)
+                slot.clear()
+                for key in keys:
+                    watched = self._timeouts.get(key, None)
+                    if watched is None:
+                        continue
+                    timeout, on_expire = watched
+                    deadline = self._last_seen[key] + timeout
+                    if deadline <= now:
+                        del self._timeouts[key]
+                        del self._last_seen[key]
+                        expired.append(on_expire)
+                    else:
+                        self._file(key, deadline)
+        for on_expire in expired:
+            try:
+                on_expire()
+            except Exception:
+                traceback.print_exc()
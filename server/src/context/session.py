@@ -1,37 +1,55 @@
 import json
 from datetime import datetime
 from enum import Enum
-from io import TextIOBase
-import time, zipfile, os
-from typing import Callable, Dict, Optional, Union
+from pathlib import Path
+import time
+from threading import RLock
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
 import src.context as ctx
-from .mqtt_utils import MQTTClient
+from .metrics import RateMeter
 from .participant import Participant
-from .position_format_utils import convert_trajectory_files
+from .position_format_utils import iso_to_epoch_ms
+from .post_session import PostSessionJob
+from .scheduler import ScheduledTask
+from .session_log import SessionLogWriter
+from .swarm_aggregate import SwarmAggregator
+from .update_format import decode_update, is_binary_update
 import re
 
-class SessionCommunicator(MQTTClient):
+if TYPE_CHECKING:
+    from .session_router import SessionRouter
+
+QUESTION_FILES = ('info.json', 'img.png')
+
+def natural_sort_key(name: str):
+    # Question2 goes before Question10
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+class SessionCommunicator():
+    '''
+        Per-session view of the shared broker connection. Messages are routed
+        here by the SessionRouter, which has already parsed the topic.
+    '''
     class Status(Enum):
         DISCONNECTED = 'disconnected'
         CONNECTED = 'connected'
         SUBSCRIBED = 'subscribed'
 
-    def __init__(self, session_id: int, host='localhost', port=1883):
+    def __init__(self, session_id: int, router: 'SessionRouter'):
         self.session_id: int = session_id
+        self.router = router
         self._status = SessionCommunicator.Status.DISCONNECTED
+        # Messages received for the session, see metrics
+        self.messages = RateMeter()
 
         self.on_status_changed: Callable[[SessionCommunicator.Status], None] = None
         self.on_participant_ready: Callable[[str,int], None] = None
         self.on_participant_leave: Callable[[int,int], None] = None
+        self.on_participant_alive: Callable[[int], None] = None
         self.on_session_start: Callable[[None]] = None
         self.on_session_stop: Callable[[None]] = None
         self.on_setup_question: Callable[[str,int]] = None
-        self.on_participant_update: Callable[[int, dict]] = None
-
-        MQTTClient.__init__(self, host, port)
-        self.client.message_callback_add('swarm/session/+/control/+', self.control_message_handler)
-        self.client.message_callback_add('swarm/session/+/control', self.control_admin_message_handler)
-        self.client.message_callback_add('swarm/session/+/updates/+', self.updates_message_handler)
+        self.on_participant_update: Callable[[int, int, Sequence[float]], None] = None
 
     @property
     def status(self) -> Status:
@@ -39,37 +57,37 @@ class SessionCommunicator(MQTTClient):
 
     @status.setter
     def status(self, status: Status):
+        if status == self._status:
+            return
         self._status = status
         if self.on_status_changed:
             self.on_status_changed(self.status)
 
-    def connection_handler(self, connected, reason) -> None:
-        if not connected:
-            self.status = SessionCommunicator.Status.DISCONNECTED
-            return
+    def start(self):
+        self.router.register(self)
 
-        self.status = SessionCommunicator.Status.CONNECTED
+    def shutdown(self):
+        self.router.unregister(self.session_id)
 
-        # Subscribe to session topic
-        def callback(success: bool):
-            if success:
-                self.status = SessionCommunicator.Status.SUBSCRIBED
-        self.subscribe(f"swarm/session/{self.session_id}/#", callback)
+    def publish(self, topic, msg, post_callback=None, coalesce=False):
+        return self.router.publish(topic, msg, post_callback, coalesce)
 
-    def control_message_handler(self, client, obj, msg):
-        client_id = int(msg.topic.split('/')[-1])
-        payload = json.loads(msg.payload)
-        session_id = int(msg.topic.split('/')[-3])
+    def control_message_handler(self, client_id: int, raw_payload: bytes):
+        payload = json.loads(raw_payload)
         msg_type = payload.get('type', '')
         if msg_type == 'ready':
             self.on_participant_ready(client_id)
         elif msg_type == 'leave':
-            self.on_participant_leave(session_id,client_id)
+            self.on_participant_leave(self.session_id,client_id)
+        elif msg_type == 'alive':
+            # Heartbeat sent periodically by the clients, see --participant-timeout
+            if self.on_participant_alive:
+                self.on_participant_alive(client_id)
         else:
             print("Unknown message received in control topic")
-    def control_admin_message_handler(self, client, obj, msg):
+    def control_admin_message_handler(self, raw_payload: bytes):
 
-        payload = json.loads(msg.payload)
+        payload = json.loads(raw_payload)
         msg_type = payload.get('type', '')
         if msg_type == 'setup':
             self.on_setup_question(str(payload.get('collection_id','')),str(payload.get('question_id','')));
@@ -81,14 +99,24 @@ class SessionCommunicator(MQTTClient):
                     self.on_session_stop(payload.get('mode', ''));
                 else:
                     print("Unknown message received in control topic")
-                    # TODO: Implement a 'keep-alive' mechanism: participants must send keep-alive messages
-                    #       periodically so the server can determine if they have left without notifying
 
-    def updates_message_handler(self, client, obj, msg):
-        client_id = int(msg.topic.split('/')[-1])
-        payload = json.loads(msg.payload)
-        if self.on_participant_update:
-            self.on_participant_update(client_id, payload.get('data', {}))
+    def updates_message_handler(self, client_id: int, raw_payload: bytes):
+        if not self.on_participant_update:
+            return
+        if is_binary_update(raw_payload):
+            participant_id, timestamp_ms, position = decode_update(raw_payload)
+            if participant_id != client_id:
+                print(f"ERROR: Update for participant {participant_id} received in the topic of {client_id}")
+                return
+        else:
+            data = json.loads(raw_payload).get('data', {})
+            position = data.get('position', None)
+            timestamp = data.get('timeStamp', None)
+            if not position or not timestamp:
+                return
+            timestamp_ms = iso_to_epoch_ms(timestamp)
+        if len(position):
+            self.on_participant_update(client_id, timestamp_ms, position)
 
 class Session():
     '''
@@ -99,12 +127,13 @@ class Session():
     class Status(Enum):
         WAITING = 'waiting' # Waiting for clients to join
         ACTIVE = 'active'   # The Swarm Session is active (answering a question)
+        CLOSED = 'closed'   # Closed by the admin or for being idle, only kept as a record
         # TODO: There should be at least an additional state where the server is
         #       waiting for clients to get ready. This would be useful for the GUI
         #       to check if the session can start or not
 
     def __init__(self):
-        if ctx.AppContext.mqtt_broker is None:
+        if ctx.AppContext.mqtt_broker is None or ctx.AppContext.mqtt_router is None:
             raise RuntimeError("MQTT broker not started")
 
         Session.last_id += 1
@@ -113,12 +142,34 @@ class Session():
         self._question = None
         self._collection = None
         self.duration = 10
-        self.participants: Dict[Participant] = {}
-        self.log_file: Optional[TextIOBase] = None
-        self.resume_file: Optional[TextIOBase] = None
+        # Payload format advertised to the clients for their updates ('json' or 'binary').
+        # Both are always accepted so older clients keep working
+        self.update_format = 'json'
+        self.participants: Dict[int, Participant] = {}
+        # Indexes kept up to date by add_participant and the Participant.status setter
+        self._participants_by_name: Dict[str, Participant] = {}
+        self._status_counts: Dict[Participant.Status, int] = {status: 0 for status in Participant.Status}
+        self._participants_json: Optional[str] = None
+        self._participants_lock = RLock()
+        # OFFLINE participants marked by the liveness timer, the only ones that
+        # come back on their own: those that left or were removed join again
+        self._timed_out: Set[int] = set()
+        self.log_writer: Optional[SessionLogWriter] = None
+        # Folder of the active session, see _new_log_folder
+        self.log_folder: Optional[Path] = None
+        self.last_job: Optional[PostSessionJob] = None
+        self._pinned_keys: List[str] = []
+        self.aggregator = SwarmAggregator()
+        self._aggregate_task: Optional[ScheduledTask] = None
+        self._published_version = 0
+        # Start and stop arrive from the MQTT thread, the API and the scheduler
+        self._state_lock = RLock()
+        self._stop_task: Optional[ScheduledTask] = None
+        self._ends_at: Optional[float] = None
         self.last_session_time = None
+        self.closed_at: Optional[datetime] = None
+        # Epoch milliseconds at which the active session ends
         self.target_date = None
-        self.answers = {}
         # Obtén las claves (nombres de las colecciones) del diccionario de colecciones
         collection_keys = list(ctx.AppContext.collections.keys())
         # Verifica si hay al menos una colección en el diccionario
@@ -131,15 +182,17 @@ class Session():
                 # Obtén el nombre de la primera pregunta (objeto)
                 self._question = list(first_collection_questions)[0]
 
-        self.communicator = SessionCommunicator(self.id, port=ctx.AppContext.mqtt_broker.port)
+        self.communicator = SessionCommunicator(self.id, ctx.AppContext.mqtt_router)
         self.communicator.on_participant_ready = self.participant_ready_handler
         self.communicator.on_participant_leave = self.participant_leave_handler
+        self.communicator.on_participant_alive = self.participant_alive_handler
         self.communicator.on_participant_update = self.participant_update_handler
         self.communicator.on_session_start = self.session_start_handler
         self.communicator.on_setup_question = self.active_question
         self.communicator.on_session_stop = self.session_stop_handler
 
         self.communicator.start()
+        self._watch_idle()
 
     def __eq__(self, other):
         return isinstance(other, Session) and self.id == other.id
@@ -154,18 +207,22 @@ class Session():
 
     @property
     def ready_participants_count(self):
-        return sum(
-                participant.status == Participant.Status.READY
-                for participant in self.participants.values()
-            )
+        return self._status_counts[Participant.Status.READY]
 
     @property
     def offline_participants_count(self):
-        return sum(
-                participant.status == Participant.Status.OFFLINE
-                for participant in self.participants.values()
-            )
+        return self._status_counts[Participant.Status.OFFLINE]
     
+    @property
+    def answers(self) -> Dict[int, Tuple[int, List[float]]]:
+        return self.aggregator.answers()
+
+    @property
+    def remaining_time(self) -> Optional[float]:
+        if self._status != Session.Status.ACTIVE or self._ends_at is None:
+            return None
+        return round(max(0.0, self._ends_at - time.monotonic()), 3)
+
     @property
     def as_dict(self):
         return {
@@ -174,28 +231,119 @@ class Session():
             'question_id': self._question if self._question else None,
             'collection_id': self._collection if self._collection else None,
             'duration': self.duration,
+            'remaining_time': self.remaining_time,
+            'target_date': self.target_date,
+            'update_format': self.update_format,
+            'last_job_id': self.last_job.id if self.last_job else None,
+            'closed_at': self.closed_at.isoformat() if self.closed_at else None,
         }
 
+    def touch(self):
+        # Anything done with the session postpones its idle eviction
+        ctx.AppContext.liveness.touch(('session', self.id))
+
+    def _watch_idle(self):
+        timeout = ctx.AppContext.args.session_idle_timeout
+        if timeout > 0:
+            ctx.AppContext.liveness.watch(('session', self.id), timeout, self.idle_timeout_handler)
+
+    def idle_timeout_handler(self):
+        if self.status == Session.Status.ACTIVE:
+            # Sessions without a duration are left running until someone stops them
+            self._watch_idle()
+            return
+        print(f"Session [id={self.id}] closed after being idle")
+        ctx.AppContext.close_session(self.id)
+
+    def close(self):
+        '''
+            Stops the session if it is active and releases what it holds: its
+            route in the SessionRouter, its timers and its pinned questions.
+        '''
+        with self._state_lock:
+            if self.status == Session.Status.CLOSED:
+                return
+            self._stop('')
+            self.status = Session.Status.CLOSED
+            self.closed_at = datetime.now()
+        liveness = ctx.AppContext.liveness
+        liveness.unwatch(('session', self.id))
+        for participant_id in list(self.participants):
+            liveness.unwatch((self.id, participant_id))
+        ctx.AppContext.question_cache.unpin(self._pinned_keys)
+        self._pinned_keys = []
+        self.communicator.shutdown()
+
+    def find_participant(self, username: str) -> Optional[Participant]:
+        return self._participants_by_name.get(username.casefold(), None)
+
     def add_participant(self, username: str):
-        in_list = False
-        participant_return = None
-        for participant in self.participants.values():
-            if(participant.username.lower() == username.lower()):
-                in_list = True
+        self.touch()
+        with self._participants_lock:
+            participant = self.find_participant(username)
+            if participant is not None:
+                self._timed_out.discard(participant.id)
                 participant.status = Participant.Status.JOINED
-                participant_return = participant
-        if(in_list != True):
+                return participant
             participant = Participant(username)
+            participant.on_status_changed = self._participant_status_changed
             self.participants[participant.id] = participant
-            participant_return = participant
-        return participant_return
+            self._participants_by_name[username.casefold()] = participant
+            self._status_counts[participant.status] += 1
+            self._participants_json = None
+            return participant
+
+    def _participant_status_changed(self, participant: Participant, old: Participant.Status, new: Participant.Status):
+        with self._participants_lock:
+            self._status_counts[old] -= 1
+            self._status_counts[new] += 1
+            self._participants_json = None
 
-    def remove_participant(self, participant_id: int):
+    @property
+    def participants_json(self) -> str:
+        '''
+            Serialized list of participants, rebuilt only after a participant
+            joins or changes its status.
+        '''
+        with self._participants_lock:
+            if self._participants_json is None:
+                self._participants_json = json.dumps(
+                    [participant.as_dict for participant in self.participants.values()]
+                )
+            return self._participants_json
+
+    def remove_participant(self, participant_id: int, timed_out: bool = False):
         participant = self.participants.get(participant_id, None)
         if participant is None:
             print(f"ERROR: Participant [id={participant_id}] not found in Session [id={self.id}]")
             return
+        ctx.AppContext.liveness.unwatch((self.id, participant_id))
+        if timed_out:
+            self._timed_out.add(participant_id)
+        else:
+            self._timed_out.discard(participant_id)
         participant.status = Participant.Status.OFFLINE
+        self.aggregator.remove(participant_id)
+
+    def watch_participant(self, participant_id: int):
+        '''
+            Marks the participant OFFLINE if it sends neither updates nor 'alive'
+            messages for --participant-timeout seconds.
+        '''
+        timeout = ctx.AppContext.args.participant_timeout
+        if timeout > 0:
+            ctx.AppContext.liveness.watch(
+                (self.id, participant_id), timeout, lambda: self.participant_timeout_handler(participant_id)
+            )
+
+    def participant_timeout_handler(self, participant_id: int):
+        participant = self.participants.get(participant_id, None)
+        if participant is not None and participant.status != Participant.Status.OFFLINE:
+            print(f"Participant [id={participant_id}] of Session [id={self.id}] timed out")
+            self.remove_participant(participant_id, timed_out=True)
+
+    def participant_alive_handler(self, participant_id: int):
+        ctx.AppContext.liveness.touch((self.id, participant_id))
 
     def participant_ready_handler(self, participant_id: int):
         participant = self.participants.get(participant_id, None)
@@ -204,16 +352,22 @@ class Session():
             return
         def check_session_status ():
             if(self.status == Session.Status.ACTIVE and self.target_date is not None):
+                # Only the late joiner needs the current positions: they are sent to its
+                # own topic, embedding the snapshot that is serialized once per change
                 self.communicator.publish(
-                    f'swarm/session/{self.id}/control',
-                    json.dumps({
-                        'type': 'started',
-                        'targetDate': self.target_date,
-                        'positions': json.dumps(self.answers)
-                    })
+                    f'swarm/session/{self.id}/state/{participant_id}',
+                    '{"type":"started","targetDate":%s,"positions":%s}' % (
+                        json.dumps(self.target_date), self.aggregator.snapshot_json()
+                    ),
+                    coalesce=True
             )
-        if(participant.status == Participant.Status.JOINED):
+        self.touch()
+        # Participants that timed out can get ready again without joining again,
+        # those that left or were removed have to join first
+        if(participant.status == Participant.Status.JOINED or participant_id in self._timed_out):
+            self._timed_out.discard(participant_id)
             participant.status = Participant.Status.READY
+            self.watch_participant(participant_id)
             check_session_status()
 
     def participant_leave_handler(self, session_id: int, participant_id: int):
@@ -223,78 +377,167 @@ class Session():
     def active_question(self, collection: str,question: str):
         self._collection = collection
         self._question = question
-        
+        self.touch()
+        self.prefetch_question()
+
+    def prefetch_question(self):
+        '''
+            Pins the files of the active question in the question cache and loads
+            them, plus the next questions of the collection, before the
+            participants ask for them.
+        '''
+        cache = ctx.AppContext.question_cache
+        questions = sorted(ctx.AppContext.collections.get(self._collection, ()), key=natural_sort_key)
+        keys = []
+        if self._question in questions:
+            start = questions.index(self._question)
+            for question in questions[start:start + 1 + ctx.AppContext.args.prefetch_ahead]:
+                keys += [cache.question_key(self._collection, question, name) for name in QUESTION_FILES]
+        pinned_keys = keys[:len(QUESTION_FILES)]
+        cache.pin(pinned_keys)
+        cache.unpin(self._pinned_keys)
+        self._pinned_keys = pinned_keys
+        cache.prefetch(keys)
 
     def session_start_handler(self, duration: int) -> bool:
+        self.touch()
+        with self._state_lock:
+            return self._start(duration)
+
+    def _start(self, duration: int) -> bool:
         if(self.status == Session.Status.WAITING):
             self.duration =  duration
             self.last_session_time = datetime.now()
-            log_folder = ctx.SESSION_LOG_FOLDER / self.last_session_time.strftime(self.regular_expresion)
-            log_folder.mkdir(parents=True, exist_ok=True)
+            log_folder = self.log_folder = self._new_log_folder()
+            info = {
+                'time': self.last_session_time.isoformat(),
+                'id': self.id,
+                'collection': self._collection,
+                'question': self._question,
+                'duration': self.duration
+            }
             with open(log_folder / 'session.json', 'w') as f:
-                json.dump({
-                    'time': self.last_session_time.isoformat(),
-                    'id': self.id,
-                    'collection': self._collection,
-                    'question': self._question,
-                    'duration': self.duration
-                }, f, indent=4)
-
-            self.log_file = open(log_folder / 'log.csv', 'w')
-            self.resume_file = open(log_folder / 'resume.csv', 'w')
+                json.dump(info, f, indent=4)
+
+            self.log_writer = SessionLogWriter([
+                sink for storage in ctx.AppContext.storages for sink in storage.log_sinks(log_folder, info)
+            ])
+            if ctx.AppContext.args.aggregate_tick > 0:
+                self._aggregate_task = ctx.AppContext.scheduler.call_every(
+                    ctx.AppContext.args.aggregate_tick, self.publish_aggregate
+                )
+            if self.duration > 0:
+                # The server ends the session even if the admin client never sends 'stop'
+                self._ends_at = time.monotonic() + self.duration
+                self.target_date = int(time.time() * 1000) + self.duration * 1000
+                started = self.last_session_time
+                self._stop_task = ctx.AppContext.scheduler.call_at(
+                    self._ends_at + ctx.AppContext.args.session_stop_grace,
+                    lambda: self.session_timeout_handler(started)
+                )
             self.status = Session.Status.ACTIVE
+            return True
+        return False
+
+    def _new_log_folder(self) -> Path:
+        # Named after the start time. Sessions started within the same second
+        # get a suffix instead of sharing the folder and its log files
+        name = self.last_session_time.strftime(self.regular_expresion)
+        suffix = 1
+        while True:
+            log_folder = ctx.SESSION_LOG_FOLDER / (name if suffix == 1 else f"{name}-{suffix}")
+            try:
+                log_folder.mkdir(parents=True)
+                return log_folder
+            except FileExistsError:
+                suffix += 1
+
+    def session_timeout_handler(self, started: datetime):
+        with self._state_lock:
+            # A task that was already running when its session was stopped and
+            # started again must not stop the new one
+            if self.status != Session.Status.ACTIVE or self.last_session_time is not started:
+                return
+            print(f"Session [id={self.id}] reached its duration of {self.duration} s")
+            # The 'stop' of the admin usually arrives after this and is ignored,
+            # so its mode is applied here
+            self._stop(ctx.AppContext.args.auto_stop_mode)
+        self.communicator.publish(
+            f'swarm/session/{self.id}/state',
+            json.dumps({'type': 'stopped', 'reason': 'timeout'})
+        )
+
+    def publish_aggregate(self):
+        '''
+            Publishes the collective position of the swarm, so clients can follow
+            one topic instead of the updates of every participant.
+        '''
+        if self.aggregator.version == self._published_version:
+            return
+        aggregate = self.aggregator.compute()
+        if aggregate is None:
+            return
+        self._published_version = aggregate.pop('version')
+        aggregate['timeStamp'] = int(time.time() * 1000)
+        self.communicator.publish(
+            f'swarm/session/{self.id}/aggregate',
+            json.dumps(aggregate, separators=(',', ':')),
+            coalesce=True
+        )
 
     def session_stop_handler(self,mode: str):
-        def generate_zip():
-                try:
-                    folder_path = self.last_session_time.strftime(self.regular_expresion)
-                    zip_filename = folder_path + ".zip"
-                    folder_path = "./session_log/" + folder_path
-                    zip_path = os.path.join("./session_log/zips", zip_filename)  # Ruta completa del archivo ZIP
-                    with zipfile.ZipFile(zip_path, "w") as zipf:
-                        for root, _, files in os.walk(folder_path):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                zipf.write(file_path, os.path.relpath(file_path, folder_path))
-                except Exception as e:
-                    print(f"Error al generar el archivo ZIP: {str(e)}")
+        self.touch()
+        with self._state_lock:
+            return self._stop(mode)
+
+    def _stop(self, mode: str) -> bool:
         if(self.status == Session.Status.ACTIVE):
-            log_folder = ctx.SESSION_LOG_FOLDER / self.last_session_time.strftime(self.regular_expresion)
-            with open(log_folder / 'session.json', 'r+') as file:
-                data = json.load(file)
-                data['participants'] = ([participant.as_dict for participant in self.participants.values()])
-                file.seek(0)
-                json.dump(data, file, indent=4)
-
-            if self.log_file:
-                self.log_file.close()
-                self.log_file = None
-            if self.resume_file:
-                for a in self.answers:
-                    self.resume_file.write(f"{a},{self.answers[a]}\n")
-                self.resume_file.close()
-                self.resume_file = None
-                self.answers = {}
-            if mode == 'trajectories':
-                convert_trajectory_files(log_folder)
-            generate_zip()
+            log_folder = self.log_folder
+            # The log, resume, trajectories and zip are finished by the post-session
+            # pipeline so this handler does not block the MQTT network thread
+            self.last_job = ctx.AppContext.post_session.submit(PostSessionJob(
+                self.id,
+                log_folder,
+                self.log_writer,
+                [participant.as_dict for participant in self.participants.values()],
+                self.answers,
+                trajectories=mode == 'trajectories',
+            ))
+            self.log_writer = None
+            self.log_folder = None
+            if self._aggregate_task:
+                self._aggregate_task.cancel()
+                self._aggregate_task = None
+            if self._stop_task:
+                self._stop_task.cancel()
+                self._stop_task = None
+            self._ends_at = None
+            self.target_date = None
+            self.aggregator.clear()
+            self._published_version = 0
             self.status = Session.Status.WAITING
+            return True
+        return False
 
-    def participant_update_handler(self, participant_id: int, data: dict):
-        position_data = data.get('position', None)
-        timestamp = data.get('timeStamp', None)
-        if position_data and timestamp:
-            sum_position = 0
-            for i, position in enumerate(position_data):
-                if position < 0:
-                    position_data[i] = 0
-                sum_position += position_data[i]
-            if sum_position > 1:
-                for i in range(len(position_data)):
-                    position_data[i] = position_data[i] / sum_position
-            
-            if not position_data:
+    def participant_update_handler(self, participant_id: int, timestamp_ms: int, position: Sequence[float]):
+        participant = self.participants.get(participant_id, None)
+        if participant is not None and participant.status == Participant.Status.OFFLINE:
+            if participant_id not in self._timed_out:
+                # Left or removed: a late or replayed update must not bring it
+                # back into the log and the aggregate
                 return
-            if self.log_file:
-                self.log_file.write(f"{participant_id},{timestamp},{','.join(str(e) for e in position_data)}\n")
-                self.answers[participant_id] = timestamp + "," + ','.join(str(e) for e in position_data)
+            # Still sending after it timed out: it is back, so it is watched
+            # again like the rest instead of only being aggregated
+            self._timed_out.discard(participant_id)
+            participant.status = Participant.Status.READY
+            self.watch_participant(participant_id)
+        else:
+            ctx.AppContext.liveness.touch((self.id, participant_id))
+        self.touch()
+        # Read once: the session may be stopped from another thread meanwhile
+        log_writer = self.log_writer
+        if log_writer:
+            # Positions are normalized in batches when the log blocks are written
+            # and when the answers are read, not on every update
+            log_writer.append(participant_id, timestamp_ms, position)
+            self.aggregator.update(participant_id, timestamp_ms, position)
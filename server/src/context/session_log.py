@@ -0,0 +1,311 @@
+from __future__ import annotations
+import queue
+import struct
+import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import deque
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Deque, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .metrics import LOG_BYTES, LOG_ROWS
+from .position_format_utils import epoch_ms_to_iso, normalize_positions
+
+BINARY_LOG_MAGIC = b'HLOG'
+BINARY_LOG_VERSION = 1
+# magic, version, reserved, width, rows
+BINARY_BLOCK_HEADER = struct.Struct('<4sBBHI')
+# Row widths are stored as uint8
+MAX_LOG_WIDTH = 255
+# Seconds SessionLogWriter.close waits for the pending blocks to be written
+CLOSE_TIMEOUT = 60.0
+
+
+class LogBlock:
+    '''
+        Preallocated columns for a fixed number of participant updates.
+    '''
+    def __init__(self, capacity: int, width: int):
+        self.capacity = capacity
+        self.width = width
+        self.size = 0
+        self.participant_ids = np.empty(capacity, dtype=np.int32)
+        self.timestamps = np.empty(capacity, dtype=np.int64)
+        self.widths = np.empty(capacity, dtype=np.uint8)
+        # float64 like the Python floats normalized one by one before: the
+        # sum > 1 test and the values written to log.csv do not change
+        self.positions = np.zeros((capacity, width), dtype=np.float64)
+
+    @property
+    def full(self) -> bool:
+        return self.size == self.capacity
+
+    def append(self, participant_id: int, timestamp_ms: int, position: Sequence[float]):
+        i = self.size
+        n = len(position)
+        self.participant_ids[i] = participant_id
+        self.timestamps[i] = timestamp_ms
+        self.widths[i] = n
+        row = self.positions[i]
+        row[:n] = position
+        row[n:] = 0
+        self.size = i + 1
+
+
+class LogSink(ABC):
+    '''
+        Where a SessionLogWriter writes its blocks. path names the log in the
+        error messages.
+    '''
+    # Label of the bytes written in the metrics
+    kind = 'file'
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.bytes_written = 0
+
+    @abstractmethod
+    def write_block(self, block: LogBlock): ...
+
+    @abstractmethod
+    def close(self): ...
+
+
+class FileLogSink(LogSink):
+    mode = 'w'
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.file = open(path, self.mode)
+
+    def close(self):
+        self.file.close()
+
+
+class CsvLogSink(FileLogSink):
+    '''
+        Writes the blocks in the historical log.csv format:
+        participant_id,timestamp,position...
+    '''
+    kind = 'csv'
+
+    def write_block(self, block: LogBlock):
+        n = block.size
+        values = block.positions[:n].astype(str)
+        second_prefix = {}
+        lines = []
+        for i in range(n):
+            timestamp = int(block.timestamps[i])
+            seconds, millis = divmod(timestamp, 1000)
+            prefix = second_prefix.get(seconds, None)
+            if prefix is None:
+                prefix = epoch_ms_to_iso(seconds * 1000)[:-4]
+                second_prefix[seconds] = prefix
+            lines.append(
+                f"{block.participant_ids[i]},{prefix}{millis:03d}Z,"
+                f"{','.join(values[i, :block.widths[i]])}\n"
+            )
+        data = ''.join(lines)
+        self.file.write(data)
+        self.bytes_written += len(data)
+
+
+class BinaryLogSink(FileLogSink):
+    '''
+        Columnar binary log: a sequence of blocks, each one made of a header
+        followed by the participant ids (int32), timestamps (int64 epoch ms),
+        row widths (uint8) and positions (float32, rows x width).
+    '''
+    mode = 'wb'
+    kind = 'binary'
+
+    def write_block(self, block: LogBlock):
+        n = block.size
+        chunks = (
+            BINARY_BLOCK_HEADER.pack(BINARY_LOG_MAGIC, BINARY_LOG_VERSION, 0, block.width, n),
+            block.participant_ids[:n].tobytes(),
+            block.timestamps[:n].tobytes(),
+            block.widths[:n].tobytes(),
+            block.positions[:n].astype(np.float32).tobytes(),
+        )
+        for chunk in chunks:
+            self.file.write(chunk)
+            self.bytes_written += len(chunk)
+
+
+def iter_binary_log(path) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+    """Yields (participant_ids, timestamps, widths, positions) for every block
+    of a binary log, reading one block at a time"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(BINARY_BLOCK_HEADER.size)
+            if not header:
+                return
+            magic, version, _, width, rows = BINARY_BLOCK_HEADER.unpack(header)
+            if magic != BINARY_LOG_MAGIC or version != BINARY_LOG_VERSION:
+                raise ValueError(f"{path} is not a binary session log")
+            participant_ids = np.frombuffer(f.read(rows * 4), dtype=np.int32)
+            timestamps = np.frombuffer(f.read(rows * 8), dtype=np.int64)
+            widths = np.frombuffer(f.read(rows), dtype=np.uint8)
+            positions = np.frombuffer(f.read(rows * width * 4), dtype=np.float32).reshape(rows, width)
+            yield participant_ids, timestamps, widths, positions
+
+
+def create_log_sinks(log_folder: Path, log_format: str) -> List[LogSink]:
+    sinks = []
+    if log_format in ('csv', 'both'):
+        sinks.append(CsvLogSink(log_folder / 'log.csv'))
+    if log_format in ('binary', 'both'):
+        sinks.append(BinaryLogSink(log_folder / 'log.bin'))
+    if not sinks:
+        raise ValueError(f"Unknown log format: {log_format}")
+    return sinks
+
+
+class _BlockFlusher:
+    '''
+        Background thread shared by every SessionLogWriter. Full blocks are
+        written as soon as they are handed over and partially filled blocks
+        are collected every flush interval.
+    '''
+    def __init__(self, flush_interval: float = 1.0):
+        self.flush_interval = flush_interval
+        self.queue: queue.Queue = queue.Queue()
+        self.writers = weakref.WeakSet()
+        self.lock = Lock()
+        self.thread: Optional[Thread] = None
+
+    def register(self, writer: SessionLogWriter):
+        with self.lock:
+            self.writers.add(writer)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name='session-log-flusher', daemon=True)
+                self.thread.start()
+
+    def submit(self, writer: SessionLogWriter, block: Optional[LogBlock]):
+        self.queue.put((writer, block))
+
+    def _run(self):
+        next_sweep = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                writer, block = self.queue.get(timeout=max(0.0, next_sweep - time.monotonic()))
+            except queue.Empty:
+                writer = None
+            # This thread is shared by every session: an error in one writer
+            # must not stop the logs of the others
+            if writer is not None:
+                try:
+                    if block is None:
+                        writer._close_sinks()
+                    else:
+                        writer._write_block(block)
+                except Exception as e:
+                    print(f"ERROR: Could not write session log: {e}")
+            if time.monotonic() >= next_sweep:
+                for writer in list(self.writers):
+                    try:
+                        writer.flush()
+                    except Exception as e:
+                        print(f"ERROR: Could not flush session log: {e}")
+                next_sweep = time.monotonic() + self.flush_interval
+
+
+_flusher = _BlockFlusher()
+
+
+class SessionLogWriter:
+    '''
+        Accumulates raw participant updates in preallocated blocks, normalizes
+        them block by block and writes them to the sinks from a background
+        thread, either when a block is full or when the flush interval elapses.
+    '''
+    def __init__(self, sinks: List[LogSink], capacity: int = 4096):
+        self.sinks = sinks
+        self.capacity = capacity
+        self.rows = 0
+        self._lock = Lock()
+        self._block: Optional[LogBlock] = None
+        self._spare: Deque[LogBlock] = deque()
+        self._closed = False
+        self._done = Event()
+        _flusher.register(self)
+
+    @property
+    def bytes_written(self) -> int:
+        return sum(sink.bytes_written for sink in self.sinks)
+
+    def append(self, participant_id: int, timestamp_ms: int, position: Sequence[float]):
+        if len(position) > MAX_LOG_WIDTH:
+            raise ValueError(f"Updates of more than {MAX_LOG_WIDTH} answers cannot be logged")
+        with self._lock:
+            if self._closed:
+                return
+            block = self._block
+            if block is None or len(position) > block.width:
+                if block is not None and block.size:
+                    self._hand_off()
+                block = self._block = self._new_block(len(position))
+            block.append(participant_id, timestamp_ms, position)
+            self.rows += 1
+            if block.full:
+                self._hand_off()
+
+    def flush(self):
+        with self._lock:
+            if self._block is not None and self._block.size:
+                self._hand_off()
+
+    def close(self, timeout: Optional[float] = CLOSE_TIMEOUT) -> bool:
+        """Writes the pending updates, closes the sinks and waits for it.
+        Returns False if that did not finish within the timeout"""
+        with self._lock:
+            if not self._closed:
+                if self._block is not None and self._block.size:
+                    self._hand_off()
+                self._closed = True
+                _flusher.submit(self, None)
+        if not self._done.wait(timeout):
+            print(f"ERROR: Session log not closed after {timeout} s")
+            return False
+        return True
+
+    def _new_block(self, width: int) -> LogBlock:
+        while self._spare:
+            block = self._spare.popleft()
+            if block.width >= width:
+                return block
+        return LogBlock(self.capacity, width)
+
+    def _hand_off(self):
+        # Called with the lock held
+        block = self._block
+        _flusher.submit(self, block)
+        self._block = self._new_block(block.width)
+
+    def _write_block(self, block: LogBlock):
+        normalize_positions(block.positions[:block.size], out=block.positions[:block.size])
+        for sink in self.sinks:
+            written = sink.bytes_written
+            try:
+                sink.write_block(block)
+            except Exception as e:
+                print(f"ERROR: Could not write session log {sink.path}: {e}")
+            LOG_BYTES.labels(sink.kind).inc(sink.bytes_written - written)
+        LOG_ROWS.labels().inc(block.size)
+        block.size = 0
+        self._spare.append(block)
+
+    def _close_sinks(self):
+        try:
+            for sink in self.sinks:
+                try:
+                    sink.close()
+                except Exception as e:
+                    print(f"ERROR: Could not close session log {sink.path}: {e}")
+        finally:
+            _flusher.writers.discard(self)
+            self._done.set()
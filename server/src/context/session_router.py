@@ -0,0 +1,97 @@
+import time
+from typing import Dict
+
+from .metrics import MQTT_HANDLER_ERRORS, MQTT_HANDLER_SECONDS
+from .mqtt_utils import MQTTClient
+from .session import SessionCommunicator
+
+
+class SessionRouter(MQTTClient):
+    '''
+        Single broker connection shared by every Session. It subscribes once to
+        the session topics and dispatches each message to the communicator
+        registered for the session id found in the topic.
+    '''
+    TOPICS = (
+        'swarm/session/+/control/+',
+        'swarm/session/+/control',
+        'swarm/session/+/updates/+',
+    )
+
+    def __init__(self, host='localhost', port=1883):
+        MQTTClient.__init__(self, host, port)
+        self.routes: Dict[int, SessionCommunicator] = {}
+        self.subscribed = False
+        self.client.on_message = self.message_handler
+        # Children of the handler metrics, resolved once
+        self._handler_metrics = {
+            handler: (MQTT_HANDLER_SECONDS.labels(handler), MQTT_HANDLER_ERRORS.labels(handler))
+            for handler in ('control', 'admin_control', 'updates')
+        }
+
+    def register(self, communicator: SessionCommunicator):
+        self.routes[communicator.session_id] = communicator
+        communicator.status = self.communicator_status
+
+    def unregister(self, session_id: int):
+        communicator = self.routes.pop(session_id, None)
+        if communicator is not None:
+            communicator.status = SessionCommunicator.Status.DISCONNECTED
+
+    @property
+    def communicator_status(self) -> SessionCommunicator.Status:
+        if self.subscribed:
+            return SessionCommunicator.Status.SUBSCRIBED
+        if self.connected:
+            return SessionCommunicator.Status.CONNECTED
+        return SessionCommunicator.Status.DISCONNECTED
+
+    def _broadcast_status(self):
+        status = self.communicator_status
+        for communicator in list(self.routes.values()):
+            communicator.status = status
+
+    def connection_handler(self, connected, reason) -> None:
+        self.subscribed = False
+        self._broadcast_status()
+        if not connected:
+            return
+
+        # Subscribe once to the topics of every session
+        def callback(success: bool):
+            if success:
+                self.subscribed = True
+                self._broadcast_status()
+        self.subscribe([(topic, 0) for topic in SessionRouter.TOPICS], callback)
+
+    def message_handler(self, client, obj, msg):
+        # swarm/session/<session_id>/<kind>[/<participant_id>]
+        levels = msg.topic.split('/')
+        if len(levels) < 4:
+            return
+        if levels[3] == 'control':
+            handler = 'control' if len(levels) > 4 else 'admin_control'
+        elif levels[3] == 'updates':
+            handler = 'updates'
+        else:
+            return
+        seconds, errors = self._handler_metrics[handler]
+        start = time.perf_counter()
+        try:
+            communicator = self.routes.get(int(levels[2]), None)
+            if communicator is None:
+                return
+            communicator.messages.mark()
+            if handler == 'control':
+                communicator.control_message_handler(int(levels[4]), msg.payload)
+            elif handler == 'admin_control':
+                communicator.control_admin_message_handler(msg.payload)
+            else:
+                communicator.updates_message_handler(int(levels[4]), msg.payload)
+        except Exception as e:
+            errors.inc()
+            # A malformed message must not bring down the connection shared by all sessions
+            print(f"ERROR: Could not handle message on topic {msg.topic}: {e}")
+        finally:
+            # Failed and slow messages too, they are the ones worth seeing
+            seconds.observe(time.perf_counter() - start)
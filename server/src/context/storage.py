@@ -0,0 +1,203 @@
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import closing
+from itertools import groupby
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .position_format_utils import epoch_ms_to_iso
+from .session_log import LogBlock, LogSink, create_log_sinks
+
+# Final answer of a participant: (timestamp_ms, weights)
+Answer = Tuple[int, List[float]]
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    log TEXT PRIMARY KEY,
+    session_id INTEGER,
+    time TEXT,
+    collection TEXT,
+    question TEXT,
+    duration INTEGER
+);
+CREATE TABLE IF NOT EXISTS updates (
+    log TEXT NOT NULL,
+    participant_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    -- Normalized weights, float64 little-endian
+    position BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS updates_log ON updates (log, timestamp);
+CREATE TABLE IF NOT EXISTS answers (
+    log TEXT NOT NULL,
+    participant_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    PRIMARY KEY (log, participant_id)
+);
+-- One row per answer option, so the answers can be aggregated in SQL
+CREATE TABLE IF NOT EXISTS answer_weights (
+    log TEXT NOT NULL,
+    participant_id INTEGER NOT NULL,
+    answer INTEGER NOT NULL,
+    weight REAL NOT NULL,
+    PRIMARY KEY (log, participant_id, answer)
+);
+CREATE INDEX IF NOT EXISTS sessions_question ON sessions (collection, question);
+'''
+# PRAGMA user_version of the databases with this schema
+SQLITE_SCHEMA_VERSION = 1
+
+
+class SessionStorage(ABC):
+    '''
+        Where the data of a session goes: the updates, through the log sinks
+        of its SessionLogWriter, and the final answers once it stops.
+    '''
+    @abstractmethod
+    def log_sinks(self, log_folder: Path, info: dict) -> List[LogSink]: ...
+
+    @abstractmethod
+    def save_answers(self, log_folder: Path, answers: Dict[int, Answer]): ...
+
+
+class FileStorage(SessionStorage):
+    '''
+        The session_log/<time>/ folders: log.csv and/or log.bin, and
+        resume.csv. The zips, the trajectories and the log index are made from
+        these files, so this storage is always used.
+    '''
+    def __init__(self, log_format: str = 'csv'):
+        self.log_format = log_format
+
+    def log_sinks(self, log_folder: Path, info: dict) -> List[LogSink]:
+        return create_log_sinks(log_folder, self.log_format)
+
+    def save_answers(self, log_folder: Path, answers: Dict[int, Answer]):
+        with open(log_folder / 'resume.csv', 'w') as resume_file:
+            for participant_id, (timestamp, weights) in answers.items():
+                resume_file.write(
+                    f"{participant_id},{epoch_ms_to_iso(timestamp)},{','.join(str(e) for e in weights)}\n"
+                )
+
+
+class SqliteLogSink(LogSink):
+    '''
+        Inserts each block of updates into the updates table in one
+        transaction.
+    '''
+    kind = 'sqlite'
+
+    def __init__(self, storage: 'SqliteStorage', log: str):
+        super().__init__(storage.path)
+        self.storage = storage
+        self.log = log
+
+    def write_block(self, block: LogBlock):
+        n = block.size
+        positions = block.positions.astype('<f8', copy=False)
+        rows = [
+            (self.log, int(block.participant_ids[i]), int(block.timestamps[i]),
+             positions[i, :block.widths[i]].tobytes())
+            for i in range(n)
+        ]
+        self.storage.insert_updates(rows)
+        self.bytes_written += sum(len(row[3]) + 16 for row in rows)
+
+    def close(self):
+        pass
+
+
+class SqliteStorage(SessionStorage):
+    '''
+        One SQLite database with the sessions, updates and answers of every
+        session, so they can be queried together instead of parsing the CSV
+        files of each folder. Timestamps are epoch milliseconds, the weights of
+        the answers one row per option and the positions of the updates
+        float64 arrays.
+    '''
+    def __init__(self, path: Path):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = Lock()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            tables = db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+            if tables and version != SQLITE_SCHEMA_VERSION:
+                db.close()
+                raise RuntimeError(f"{self.path} was created by another version of the server, use a new session store")
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SQLITE_SCHEMA)
+            db.execute(f"PRAGMA user_version = {SQLITE_SCHEMA_VERSION}")
+            self._db = db
+        return self._db
+
+    def log_sinks(self, log_folder: Path, info: dict) -> List[LogSink]:
+        question = info.get('question', None)
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sessions (log, session_id, time, collection, question, duration) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (log_folder.name, info.get('id', None), info.get('time', None), info.get('collection', None),
+                 str(question) if question is not None else None, info.get('duration', None))
+            )
+        return [SqliteLogSink(self, log_folder.name)]
+
+    def insert_updates(self, rows: List[Tuple[str, int, int, bytes]]):
+        with self._lock, self.db:
+            self.db.executemany(
+                "INSERT INTO updates (log, participant_id, timestamp, position) VALUES (?, ?, ?, ?)", rows
+            )
+
+    def save_answers(self, log_folder: Path, answers: Dict[int, Answer]):
+        log = log_folder.name
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM answer_weights WHERE log = ?", (log,))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO answers (log, participant_id, timestamp) VALUES (?, ?, ?)",
+                [(log, participant_id, timestamp) for participant_id, (timestamp, _) in answers.items()]
+            )
+            self.db.executemany(
+                "INSERT INTO answer_weights (log, participant_id, answer, weight) VALUES (?, ?, ?, ?)",
+                [(log, participant_id, answer, weight)
+                 for participant_id, (_, weights) in answers.items() for answer, weight in enumerate(weights)]
+            )
+
+    def answers(self, collection: Optional[str], question: str) -> List[dict]:
+        """Final answer of every participant of every session of a question:
+        its timestamp (epoch ms) and its weights"""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT s.log, s.session_id, s.time, a.participant_id, a.timestamp, w.weight "
+                "FROM answers a JOIN sessions s ON s.log = a.log "
+                "JOIN answer_weights w ON w.log = a.log AND w.participant_id = a.participant_id "
+                "WHERE s.collection IS ? AND s.question = ? ORDER BY s.time, a.log, a.participant_id, w.answer",
+                (collection, str(question))
+            ).fetchall()
+        return [
+            {'log': log, 'session_id': session_id, 'time': time, 'participant_id': participant_id,
+             'timestamp': timestamp, 'weights': [row[5] for row in weights]}
+            for (log, session_id, time, participant_id, timestamp), weights
+            in groupby(rows, key=lambda row: row[:5])
+        ]
+
+    def updates(self, log: str) -> Iterator[Tuple[int, int, List[float]]]:
+        """(participant_id, timestamp_ms, position) of the updates of a session
+        in time order, read as they are consumed"""
+        # A connection of its own: with WAL it reads a snapshot without holding
+        # the lock of the writers while the caller iterates. self.db creates
+        # the schema if the store was not opened yet
+        self.db
+        with closing(sqlite3.connect(self.path)) as db:
+            cursor = db.execute(
+                "SELECT participant_id, timestamp, position FROM updates WHERE log = ? ORDER BY timestamp", (log,)
+            )
+            for participant_id, timestamp, position in cursor:
+                yield participant_id, timestamp, np.frombuffer(position, dtype='<f8').tolist()
@@ -0,0 +1,131 @@
+import json
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .position_format_utils import RADIUS, epoch_ms_to_iso, normalize_positions, position_codec
+
+
+class SwarmAggregator():
+    '''
+        Latest position of every participant of a session, one row per
+        participant in a NumPy matrix. From it come the collective position,
+        the answers written to resume.csv and the snapshot sent to the
+        participants who join an active session.
+    '''
+    def __init__(self, capacity: int = 64):
+        self._lock = Lock()
+        self._allocate(capacity, 0)
+
+    def _allocate(self, capacity: int, width: int):
+        self.rows: Dict[int, int] = {}
+        self.participant_ids = np.zeros(capacity, dtype=np.int64)
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.widths = np.zeros(capacity, dtype=np.uint8)
+        self.positions = np.zeros((capacity, width))
+        self.size = 0
+        # Incremented on every change, so the tick and the snapshot cache can
+        # tell when something moved
+        self.version = 0
+        self._snapshot: Tuple[int, Optional[str]] = (-1, None)
+
+    def _grow(self, capacity: int, width: int):
+        old_capacity, old_width = self.positions.shape
+        self.participant_ids = np.resize(self.participant_ids, capacity)
+        self.timestamps = np.resize(self.timestamps, capacity)
+        self.widths = np.resize(self.widths, capacity)
+        active = np.zeros(capacity, dtype=bool)
+        active[:old_capacity] = self.active
+        self.active = active
+        positions = np.zeros((capacity, width))
+        positions[:old_capacity, :old_width] = self.positions
+        self.positions = positions
+
+    def update(self, participant_id: int, timestamp_ms: int, position: Sequence[float]):
+        with self._lock:
+            n = len(position)
+            row = self.rows.get(participant_id, None)
+            capacity, width = self.positions.shape
+            if row is None:
+                row = self.rows[participant_id] = self.size
+                self.size += 1
+            if self.size > capacity or n > width:
+                self._grow(2 * capacity if self.size > capacity else capacity, max(width, n))
+            self.participant_ids[row] = participant_id
+            values = self.positions[row]
+            values[:n] = position
+            values[n:] = 0
+            self.timestamps[row] = timestamp_ms
+            self.widths[row] = n
+            self.active[row] = True
+            self.version += 1
+
+    def remove(self, participant_id: int):
+        with self._lock:
+            row = self.rows.get(participant_id, None)
+            if row is not None and self.active[row]:
+                self.active[row] = False
+                self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._allocate(self.positions.shape[0], 0)
+
+    def compute(self) -> Optional[dict]:
+        """Mean of the normalized positions of the active participants and the
+        2D point it decodes to (normalized by the radius)"""
+        with self._lock:
+            active = self.active[:self.size]
+            positions = self.positions[:self.size][active]
+            version = self.version
+        if len(positions) == 0:
+            return None
+        mean = normalize_positions(positions).mean(axis=0)
+        num_answers = len(mean)
+        point = position_codec(num_answers).decode(mean) / RADIUS if num_answers > 2 else None
+        return {
+            'version': version,
+            'participants': len(positions),
+            'position': mean.tolist(),
+            'point': point.tolist() if point is not None else None,
+        }
+
+    def _rows(self, only_active: bool):
+        with self._lock:
+            rows = self.active[:self.size] if only_active else slice(0, self.size)
+            return (
+                self.version,
+                self.participant_ids[:self.size][rows],
+                self.timestamps[:self.size][rows],
+                self.widths[:self.size][rows],
+                normalize_positions(self.positions[:self.size][rows]),
+            )
+
+    def answers(self) -> Dict[int, Tuple[int, List[float]]]:
+        """Last answer of every participant that sent one, including those who
+        left, as (timestamp_ms, weights)"""
+        _, participant_ids, timestamps, widths, positions = self._rows(only_active=False)
+        return {
+            participant_id: (timestamp, row[:width])
+            for participant_id, timestamp, width, row in zip(
+                participant_ids.tolist(), timestamps.tolist(), widths.tolist(), positions.tolist()
+            )
+        }
+
+    def snapshot_json(self) -> str:
+        """Current position of the active participants, serialized once per
+        version however many participants ask for it"""
+        version, cached = self._snapshot
+        if version == self.version and cached is not None:
+            return cached
+        version, participant_ids, timestamps, widths, positions = self._rows(only_active=True)
+        cached = json.dumps({
+            str(participant_id): {'timeStamp': epoch_ms_to_iso(timestamp), 'position': row[:width]}
+            for participant_id, timestamp, width, row in zip(
+                participant_ids.tolist(), timestamps.tolist(), widths.tolist(), positions.tolist()
+            )
+        }, separators=(',', ':'))
+        self._snapshot = (version, cached)
+        return cached
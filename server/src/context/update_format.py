@@ -0,0 +1,41 @@
+"""Compact binary payload for the participant updates published on
+swarm/session/<id>/updates/<participant_id>.
+
+    version   uint8    UPDATE_FORMAT_VERSION
+    flags     uint8    reserved, 0
+    k         uint16   number of answer weights
+    id        uint32   participant id (must match the topic)
+    timestamp int64    milliseconds since the epoch
+    weights   float32  k answer weights
+
+All fields are little endian. JSON payloads start with '{' or whitespace, so
+both formats can be told apart from the first byte.
+"""
+import struct
+from typing import Sequence, Tuple
+
+import numpy as np
+
+UPDATE_FORMAT_VERSION = 1
+UPDATE_HEADER = struct.Struct('<BBHIq')
+UPDATE_FORMATS = ('json', 'binary')
+
+
+def is_binary_update(payload: bytes) -> bool:
+    return payload[:1] == b'\x01'
+
+
+def encode_update(participant_id: int, timestamp_ms: int, position: Sequence[float]) -> bytes:
+    weights = np.asarray(position, dtype='<f4')
+    return UPDATE_HEADER.pack(UPDATE_FORMAT_VERSION, 0, len(weights), participant_id, timestamp_ms) + weights.tobytes()
+
+
+def decode_update(payload: bytes) -> Tuple[int, int, np.ndarray]:
+    """Returns (participant_id, timestamp_ms, weights). The weights are a
+    read-only view over the payload"""
+    version, _, k, participant_id, timestamp_ms = UPDATE_HEADER.unpack_from(payload)
+    if version != UPDATE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported update format version {version}")
+    if len(payload) != UPDATE_HEADER.size + 4 * k:
+        raise ValueError(f"Update payload of {len(payload)} bytes does not hold {k} weights")
+    return participant_id, timestamp_ms, np.frombuffer(payload, dtype='<f4', count=k, offset=UPDATE_HEADER.size)
@@ -1,20 +1,97 @@
+import signal
 import sys
 from argparse import ArgumentParser
+from pathlib import Path
 from .services import start_services,stop_services
-from .context import AppContext
+from .context import AppContext, SqliteStorage
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--api-port', dest='api_port', type=int,
                         help=f"HTTP API port. Default: {AppContext.args.api_port}",
                         default=AppContext.args.api_port)
+    parser.add_argument('--server', dest='server', choices=['werkzeug', 'waitress'],
+                        help=f"HTTP server: werkzeug development server or waitress (bounded threads, keep-alive). Default: {AppContext.args.server}",
+                        default=AppContext.args.server)
+    parser.add_argument('--api-threads', dest='api_threads', type=int,
+                        help=f"Threads that serve HTTP requests with --server waitress. Default: {AppContext.args.api_threads}",
+                        default=AppContext.args.api_threads)
+    parser.add_argument('--api-connection-limit', dest='api_connection_limit', type=int,
+                        help=f"Open HTTP connections accepted with --server waitress. Default: {AppContext.args.api_connection_limit}",
+                        default=AppContext.args.api_connection_limit)
+    parser.add_argument('--api-shutdown-timeout', dest='api_shutdown_timeout', type=float,
+                        help=f"Seconds given to the requests being served when the server stops. Default: {AppContext.args.api_shutdown_timeout}",
+                        default=AppContext.args.api_shutdown_timeout)
     parser.add_argument('--mqtt-port', dest='mqtt_port', type=int,
                         help=f"MQTT Broker port. Default: {AppContext.args.mqtt_port}",
                         default=AppContext.args.mqtt_port)
+    parser.add_argument('--log-format', dest='log_format', choices=['csv', 'binary', 'both'],
+                        help=f"Session log format (log.csv, columnar log.bin or both). Default: {AppContext.args.log_format}",
+                        default=AppContext.args.log_format)
+    parser.add_argument('--post-session-workers', dest='post_session_workers', type=int,
+                        help=f"Workers that finish the logs, trajectories and zips of stopped sessions. Default: {AppContext.args.post_session_workers}",
+                        default=AppContext.args.post_session_workers)
+    parser.add_argument('--post-session-shutdown-timeout', dest='post_session_shutdown_timeout', type=float,
+                        help=f"Seconds the server waits on exit for the post-session jobs still queued. Default: {AppContext.args.post_session_shutdown_timeout}",
+                        default=AppContext.args.post_session_shutdown_timeout)
+    parser.add_argument('--question-cache-mb', dest='question_cache_mb', type=int,
+                        help=f"Memory used to cache question files from S3, in MB. Default: {AppContext.args.question_cache_mb}",
+                        default=AppContext.args.question_cache_mb)
+    parser.add_argument('--question-cache-ttl', dest='question_cache_ttl', type=float,
+                        help=f"Seconds before a cached question file is revalidated against S3. Default: {AppContext.args.question_cache_ttl}",
+                        default=AppContext.args.question_cache_ttl)
+    parser.add_argument('--question-cache-dir', dest='question_cache_dir', type=Path,
+                        help="Folder where question files are also cached on disk. Disabled by default",
+                        default=AppContext.args.question_cache_dir)
+    parser.add_argument('--collections-index', dest='collections_index', type=Path,
+                        help=f"File where the collection index is saved to speed up the start. Default: {AppContext.args.collections_index}",
+                        default=AppContext.args.collections_index)
+    parser.add_argument('--log-index', dest='log_index', type=Path,
+                        help=f"SQLite index of the session logs. Default: {AppContext.args.log_index}",
+                        default=AppContext.args.log_index)
+    parser.add_argument('--session-store', dest='session_store', type=Path,
+                        help="SQLite database where the updates and answers of every session are also saved. Disabled by default",
+                        default=AppContext.args.session_store)
+    parser.add_argument('--s3-list-workers', dest='s3_list_workers', type=int,
+                        help=f"Collections listed in parallel from S3. Default: {AppContext.args.s3_list_workers}",
+                        default=AppContext.args.s3_list_workers)
+    parser.add_argument('--prefetch-ahead', dest='prefetch_ahead', type=int,
+                        help=f"Questions after the active one that are prefetched from S3. Default: {AppContext.args.prefetch_ahead}",
+                        default=AppContext.args.prefetch_ahead)
+    parser.add_argument('--aggregate-tick', dest='aggregate_tick', type=float,
+                        help=f"Seconds between aggregate swarm positions published per session, 0 to disable. Default: {AppContext.args.aggregate_tick}",
+                        default=AppContext.args.aggregate_tick)
+    parser.add_argument('--participant-timeout', dest='participant_timeout', type=float,
+                        help=f"Seconds without updates or 'alive' messages before a ready participant is marked offline, 0 to disable. Default: {AppContext.args.participant_timeout}",
+                        default=AppContext.args.participant_timeout)
+    parser.add_argument('--session-stop-grace', dest='session_stop_grace', type=float,
+                        help=f"Seconds after the duration of a session before the server stops it, so the last updates arrive. Default: {AppContext.args.session_stop_grace}",
+                        default=AppContext.args.session_stop_grace)
+    parser.add_argument('--auto-stop-mode', dest='auto_stop_mode', choices=['trajectories', ''],
+                        help=f"Stop mode of the sessions stopped by the server at the end of their duration ('' skips the trajectories). Default: {AppContext.args.auto_stop_mode}",
+                        default=AppContext.args.auto_stop_mode)
+    parser.add_argument('--session-idle-timeout', dest='session_idle_timeout', type=float,
+                        help=f"Seconds without activity before a session that is not active is closed, 0 to disable. Default: {AppContext.args.session_idle_timeout}",
+                        default=AppContext.args.session_idle_timeout)
     AppContext.args = parser.parse_args()
-    AppContext.reload_collections()
+    AppContext.post_session.workers = AppContext.args.post_session_workers
+    AppContext.file_storage.log_format = AppContext.args.log_format
+    if AppContext.args.session_store:
+        AppContext.storages.append(SqliteStorage(AppContext.args.session_store))
+    AppContext.question_cache.max_bytes = AppContext.args.question_cache_mb * 1024 * 1024
+    AppContext.question_cache.ttl = AppContext.args.question_cache_ttl
+    AppContext.question_cache.disk_dir = AppContext.args.question_cache_dir
+    AppContext.collection_index.path = AppContext.args.collections_index
+    AppContext.collection_index.workers = AppContext.args.s3_list_workers
+    AppContext.log_index.path = AppContext.args.log_index
+    AppContext.load_collections()
+    AppContext.index_logs()
    
+    # SIGTERM stops the services the same way as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
         start_services();
-    except KeyboardInterrupt:
+        while AppContext.api_service.is_alive():
+            AppContext.api_service.join(1)
+    except (KeyboardInterrupt, SystemExit):
         stop_services();
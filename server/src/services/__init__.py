@@ -14,13 +14,41 @@ def start_services(
         ctx.AppContext.mqtt_broker.on_start = lambda: on_start_cb(ctx.AppContext.mqtt_broker)
     ctx.AppContext.mqtt_broker.start()
 
-    ctx.AppContext.api_service = ServerAPI(port=ctx.AppContext.args.api_port)
+    # Shared connection used by every Session to talk to the broker
+    ctx.AppContext.mqtt_router = ctx.SessionRouter('localhost', ctx.AppContext.args.mqtt_port)
+    ctx.AppContext.mqtt_router.start()
+
+    args = ctx.AppContext.args
+    ctx.AppContext.api_service = ServerAPI(
+        port=args.api_port,
+        server=args.server,
+        threads=args.api_threads,
+        connection_limit=args.api_connection_limit,
+        shutdown_timeout=args.api_shutdown_timeout,
+    )
     if on_start_cb:
         ctx.AppContext.api_service.on_start.connect(lambda: on_start_cb(ctx.AppContext.api_service))
     ctx.AppContext.api_service.start()
 
     print("Services up and running")
 
+def close_sessions():
+    # The log flusher is a daemon thread: the logs of the sessions still open
+    # must be written before the process exits
+    log_writers = []
+    for session_id, session in list(ctx.AppContext.sessions.items()):
+        log_writer = session.log_writer
+        ctx.AppContext.close_session(session_id)
+        if log_writer:
+            log_writers.append((session_id, log_writer))
+    for session_id, log_writer in log_writers:
+        if not log_writer.close():
+            print(f"ERROR: The log of Session [id={session_id}] may be incomplete")
+
 def stop_services():
+    print("Stopping services")
     ctx.AppContext.api_service.shutdown()
+    close_sessions()
+    ctx.AppContext.post_session.shutdown(ctx.AppContext.args.post_session_shutdown_timeout)
+    ctx.AppContext.mqtt_router.shutdown()
     ctx.AppContext.mqtt_broker.stop()
\ No newline at end of file
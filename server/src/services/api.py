@@ -1,28 +1,57 @@
 from pathlib import Path
-from threading import Thread
+from threading import Event, Thread
 import os
-import zipfile
 import shutil
 import re
-from flask import Flask, jsonify, send_from_directory, request
+import time
+from flask import Flask, Response, g, jsonify, send_from_directory, request
 from werkzeug.serving import make_server
-import boto3
 from src.context import AppContext, Participant, Session
+from src.context.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, HTTP_REQUEST_SECONDS
+from src.context.update_format import UPDATE_FORMATS
+from .zip_stream import ZipArchiveCache, walk_files
 
 
 class ServerAPI(Thread):
-    
-    def __init__(self, host='0.0.0.0', port=8080):
+    '''
+        HTTP API and client files. Served by the werkzeug development server
+        (one thread per connection) or by waitress, which keeps connections
+        alive on an event loop and runs the requests on a bounded pool of
+        threads.
+    '''
+    SERVERS = ('werkzeug', 'waitress')
+
+    def __init__(self, host='0.0.0.0', port=8080, server='werkzeug', threads=16, connection_limit=1000,
+                 shutdown_timeout=5.0):
         SESSION_NOT_FOUND = "Session not found"
         INVALID_REQUEST = "Invalid request"
         INVALID_CREDENTIALS="Check if your credentials are correct please"
         Thread.__init__(self)
         self.app = Flask(__name__, static_folder='../../../client/build')
+        archives = ZipArchiveCache(Path('tmp/archives'))
+        # Tiempo de cada petición por ruta, ver /api/metrics
+        @self.app.before_request
+        def start_request_timer():
+            g.request_start = time.perf_counter()
+
+        @self.app.after_request
+        def record_request_time(response):
+            start = g.pop('request_start', None)
+            if start is not None:
+                route = request.url_rule.rule if request.url_rule else 'unmatched'
+                HTTP_REQUEST_SECONDS.labels(route, request.method, response.status_code).observe(
+                    time.perf_counter() - start)
+            return response
+
         @self.app.route('/api/session/<int:session_id>', methods=['GET'])
         def api_session_handle_get(session_id: int):
             session = AppContext.sessions.get(session_id, None)
             if session is None:
-                return SESSION_NOT_FOUND, 404
+                # Las sesiones cerradas se siguen pudiendo consultar
+                archived = AppContext.archived_sessions.get(session_id, None)
+                if archived is None:
+                    return SESSION_NOT_FOUND, 404
+                return jsonify(archived)
 
             return jsonify(session.as_dict)
 
@@ -36,7 +65,21 @@ class ServerAPI(Thread):
             if(username!="admin" or password!="admin"):
                 return INVALID_CREDENTIALS, 400
             
-            return jsonify([session.as_dict for session in AppContext.sessions.values()])
+            return jsonify([session.as_dict for session in list(AppContext.sessions.values())])
+
+        # Cierra una sesión: se para si está activa y se libera todo lo que usa
+        @self.app.route('/api/session/<int:session_id>/close', methods=['POST'])
+        def api_close_session(session_id: int):
+            if 'user' not in request.json:
+                return INVALID_REQUEST, 400
+            username = request.json['user']
+            password = request.json['pass']
+            if(username!="admin" or password!="admin"):
+                return INVALID_CREDENTIALS, 400
+            record = AppContext.close_session(session_id)
+            if record is None:
+                return SESSION_NOT_FOUND, 404
+            return jsonify(record)
 
         @self.app.route('/api/session/<int:session_id>', methods=['POST'])
         def api_edit_session(session_id: int):
@@ -46,16 +89,21 @@ class ServerAPI(Thread):
 
             session_data = request.json
             if any(
-                key not in ['status', 'question_id', 'duration']
+                key not in ['status', 'question_id', 'duration', 'update_format']
                 for key in session_data.keys()
             ):
                 return "Invalid parameter", 400
 
+            session.touch()
             if 'status' in session_data:
                 try:
-                    session.status = Session.Status(session_data['status'])
+                    status = Session.Status(session_data['status'])
                 except ValueError:
                     return "Requested status is not valid", 400
+                if status == Session.Status.CLOSED:
+                    # Se cierra de verdad, no basta con cambiar el estado
+                    return jsonify(AppContext.close_session(session_id))
+                session.status = status
 
             if 'question_id' in session_data:
                 question_id = session_data['question_id']
@@ -70,6 +118,12 @@ class ServerAPI(Thread):
 
                 session.duration = session_data['duration']
 
+            if 'update_format' in session_data:
+                if session_data['update_format'] not in UPDATE_FORMATS:
+                    return f"Requested update_format must be one of {', '.join(UPDATE_FORMATS)}", 400
+
+                session.update_format = session_data['update_format']
+
             return jsonify(session.as_dict)
 
         @self.app.route('/api/session/<int:session_id>/allParticipants', methods=['POST'])
@@ -83,7 +137,7 @@ class ServerAPI(Thread):
             session = AppContext.sessions.get(session_id, None)
             if session is None:
                 return SESSION_NOT_FOUND, 404
-            return jsonify([participant.as_dict for participant in session.participants.values()])
+            return Response(session.participants_json, mimetype='application/json')
 
         # función que escucha la petición del componente sessionLogin
         @self.app.route('/api/session/<int:session_id>/participants', methods=['POST'])
@@ -95,7 +149,8 @@ class ServerAPI(Thread):
             session = AppContext.sessions.get(session_id, None)
             if session is None:
                 return SESSION_NOT_FOUND, 404
-            if any(username.lower() == participant.username.lower() and participant.status!=Participant.Status.OFFLINE for participant in session.participants.values()):
+            joined = session.find_participant(username)
+            if joined is not None and joined.status!=Participant.Status.OFFLINE:
                 return "Participant already joined session", 400
 
             participant = session.add_participant(username)
@@ -108,13 +163,12 @@ class ServerAPI(Thread):
             if session is None:
                 return SESSION_NOT_FOUND, 404
 
-            if any(participant_id == participant.id for participant in session.participants.values()):
-                if any(participant_id == participant.id and participant.status==Participant.Status.OFFLINE for participant in session.participants.values()):
-                    return "Participant already leaved session", 400
-                else:
-                    session.remove_participant(participant_id)
-            else:
+            participant = session.participants.get(participant_id, None)
+            if participant is None:
                 return "Participant not found", 404
+            if participant.status==Participant.Status.OFFLINE:
+                return "Participant already leaved session", 400
+            session.remove_participant(participant_id)
             return "Bye"
         # Devuelve las colecciones enteras
         @self.app.route('/api/collection')
@@ -126,47 +180,49 @@ class ServerAPI(Thread):
                 # Convertir el conjunto en un diccionario antes de serializarlo en JSON
                 collections_dict = {key: list(value) for key, value in collections.items()}
                 return jsonify(collections_dict)
+        def question_asset_response(collection: str, question_id: str, filename: str):
+            if collection not in AppContext.collections:
+                return "Collection not found", 404
+            if question_id not in AppContext.collections[collection]:
+                return "Question not found", 404
+
+            object_key = AppContext.question_cache.question_key(collection, question_id, filename)
+            try:
+                asset = AppContext.question_cache.get(object_key)
+            except Exception as e:
+                print(f"No se pudo acceder al objeto {object_key}: {str(e)}")
+                return "Question not available", 502
+
+            response = Response(asset.body, mimetype=asset.content_type)
+            response.set_etag(asset.etag.strip('"'))
+            response.cache_control.public = True
+            response.cache_control.max_age = int(AppContext.question_cache.ttl)
+            return response.make_conditional(request)
+
+        # Vuelve a listar las colecciones del bucket (todas o solo las indicadas)
+        @self.app.route('/api/collection/refresh', methods=['POST'])
+        def api_refresh_collections():
+            if 'user' not in request.json:
+                return INVALID_REQUEST, 400
+            username = request.json['user']
+            password = request.json['pass']
+            if(username!="admin" or password!="admin"):
+                return INVALID_CREDENTIALS, 400
+            # Solo se vuelven a listar las colecciones indicadas (las que han cambiado); sin ellas, todo el bucket
+            collections = request.json.get('collections', None)
+            if collections is not None and not isinstance(collections, list):
+                return "Requested collections must be a list", 400
+            AppContext.reload_collections(collections)
+            return jsonify({key: list(value) for key, value in AppContext.collections.items()})
         # Devuelve una pregunta en concreto
         @self.app.route('/api/question/<string:collection>/<string:question_id>')
         def api_question_handle(collection: str, question_id: str):
-            if collection in AppContext.collections:
-                if question_id in AppContext.collections[collection]:
-                    s3 = boto3.client('s3')
-                    bucket_name = 'hans-platform-collections'
-
-                    object_key = f'{collection}/{question_id}/info.json'
-                    try:
-                        response = s3.get_object(Bucket=bucket_name, Key=object_key)
-                        info_json_content = response['Body'].read()
-                        return info_json_content
-                    except Exception as e:
-                        print(f"No se pudo acceder al objeto {object_key}: {str(e)}")
-                else:
-                    return "Question not found", 404
-            else:
-                return "Collection not found", 404
-
+            return question_asset_response(collection, question_id, 'info.json')
 
-            
         #Devuelve la imagen asociada a una pregunta
         @self.app.route('/api/question/<string:collection>/<string:question_id>/image')
         def api_question_image_handle(collection: str, question_id: str):
-            if collection in AppContext.collections:
-                if question_id in AppContext.collections[collection]:
-                    s3 = boto3.client('s3')
-                    bucket_name = 'hans-platform-collections'
-
-                    object_key = f'{collection}/{question_id}/img.png'
-                    try:
-                        response = s3.get_object(Bucket=bucket_name, Key=object_key)
-                        img_content = response['Body'].read()
-                        return img_content
-                    except Exception as e:
-                        print(f"No se pudo acceder al objeto {object_key}: {str(e)}")
-                else:
-                    return "Question not found", 404
-            else:
-                return "Collection not found", 404
+            return question_asset_response(collection, question_id, 'img.png')
 
         # Serve client app
         @self.app.route('/', defaults={'path': ''})
@@ -200,9 +256,26 @@ class ServerAPI(Thread):
             session = Session()
             AppContext.sessions[session.id] = session
             return jsonify(session.as_dict)
+        # Estado de los trabajos que terminan los logs de las sesiones paradas
+        @self.app.route('/api/jobs')
+        def api_get_all_jobs():
+            return jsonify([job.as_dict for job in list(AppContext.post_session.jobs.values())])
+
+        @self.app.route('/api/jobs/<int:job_id>')
+        def api_get_job(job_id: int):
+            job = AppContext.post_session.get(job_id)
+            if job is None:
+                return "Job not found", 404
+            return jsonify(job.as_dict)
+        # Métricas en el formato de texto de Prometheus
+        @self.app.route('/api/metrics')
+        def api_metrics():
+            return Response(AppContext.metrics.render(), content_type=METRICS_CONTENT_TYPE)
         # Descarga un log en concreto
         @self.app.route('/api/downloadLog/<path:zip_filename>')
         def download_log(zip_filename):
+            if AppContext.post_session.is_pending(zip_filename):
+                return "El log todavía se está procesando", 409
             zip_filename+=".zip"
             zip_path = os.path.join("./session_log/zips", zip_filename)
             if os.path.isfile(zip_path):
@@ -212,38 +285,33 @@ class ServerAPI(Thread):
         # Descarga todos los logs
         @self.app.route('/api/downloadAllLogs')
         def download_all_logs():
-            zip_filepath = generate_all_logs_zip()
-
-            if zip_filepath and os.path.isfile(zip_filepath):
-                return send_from_directory(os.path.abspath(os.path.dirname(zip_filepath)), os.path.basename(zip_filepath), as_attachment=True)
-            else:
-                return "Error al generar el archivo ZIP", 500
-
-        def generate_all_logs_zip():
+            # Se genera mientras se descarga y solo si han cambiado los zips de los logs
             try:
-                zip_filename = "AllLogs.zip"
-                folder_path = "./session_log/zips"
-                zip_path = os.path.join("./session_log", zip_filename)  # Ruta completa del archivo ZIP
-                if os.path.isfile(zip_path):
-                    os.remove(zip_path)
-                with zipfile.ZipFile(zip_path, "w") as zipf:
-                    for root, _, files in os.walk(folder_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            zipf.write(file_path, os.path.relpath(file_path, folder_path))
-
-                return zip_path
+                return archives.response("AllLogs.zip", walk_files(Path("./session_log/zips")))
             except Exception as e:
                 print(f"Error al generar el archivo ZIP: {str(e)}")
-                return None
+                return "Error al generar el archivo ZIP", 500
 
         # Devuelve una lista con los nombres de los logs
         @self.app.route('/api/listLogs')
         def list_logs():
-            folder_path = './session_log'
-            logs = [name for name in os.listdir(folder_path) if os.path.isdir(os.path.join(folder_path, name))]
-
-            return jsonify(logs=logs)
+            # Los logs se añaden al índice cuando su trabajo de post-sesión termina
+            return jsonify(logs=AppContext.log_index.names())
+        # Busca en el índice de logs, por páginas y del más reciente al más antiguo
+        @self.app.route('/api/logs')
+        def query_logs():
+            limit = request.args.get('limit', 50, type=int)
+            offset = request.args.get('offset', 0, type=int)
+            total, logs = AppContext.log_index.query(
+                collection=request.args.get('collection', None),
+                question=request.args.get('question', None),
+                session_id=request.args.get('session_id', None, type=int),
+                since=request.args.get('from', None),
+                until=request.args.get('to', None),
+                limit=limit,
+                offset=offset,
+            )
+            return jsonify(total=total, limit=limit, offset=offset, logs=logs)
         #Borra todos los logs
         @self.app.route('/api/deleteAllLogs')
         def delete_all_logs():
@@ -271,38 +339,20 @@ class ServerAPI(Thread):
 
             except Exception:
                 return "Error deleting logs", 500
+            finally:
+                AppContext.log_index.sync(session_log_path, AppContext.post_session.is_pending)
             return jsonify({"status": "ok"})
         # Descarga todas las trayectorias
         @self.app.route('/api/downloadAllTrajectories')
         def download_all_trajectories():
-            zip_filepath = generate_all_trajectories_zip()
-
-            if zip_filepath and os.path.isfile(zip_filepath):
-                return send_from_directory(os.path.abspath(os.path.dirname(zip_filepath)), os.path.basename(zip_filepath), as_attachment=True)
-            else:
-                return "Error al generar el archivo ZIP", 500
-        def generate_all_trajectories_zip():
             try:
-                zip_filename = "AllTrajectories.zip"
-                folder_path = "./trajectories"
-                zip_path = os.path.join(folder_path, zip_filename)  # Ruta completa del archivo ZIP
-
-                # Eliminar el archivo ZIP si ya existe
-                if os.path.isfile(zip_path):
-                    os.remove(zip_path)
-
-                with zipfile.ZipFile(zip_path, "w") as zipf:
-                    for root, _, files in os.walk(folder_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            # Verificar si el archivo que se va a agregar es el propio archivo ZIP
-                            if file_path != zip_path:
-                                zipf.write(file_path, os.path.relpath(file_path, folder_path))
-
-                return zip_path
+                # AllTrajectories.zip era el zip que se generaba antes dentro de la carpeta
+                return archives.response(
+                    "AllTrajectories.zip", walk_files(Path("./trajectories"), exclude=["AllTrajectories.zip"])
+                )
             except Exception as e:
                 print(f"Error al generar el archivo ZIP: {str(e)}")
-                return None
+                return "Error al generar el archivo ZIP", 500
         # Borra todas las trayectorias
         @self.app.route('/api/deleteAllTrajectories')
         def delete_all_trajectories():
@@ -350,14 +400,75 @@ class ServerAPI(Thread):
 
             except Exception as e:
                 return "Error deleting trajectories", 500
+            finally:
+                AppContext.log_index.sync(session_path, AppContext.post_session.is_pending)
             return jsonify({"status": "ok"})
 
 
-        self.server = make_server(host, port, self.app, threaded=True)
+        self.server_name = server
+        self.shutdown_timeout = shutdown_timeout
+        if server == 'waitress':
+            try:
+                from waitress import create_server
+            except ImportError:
+                raise RuntimeError("waitress is not installed (pip install waitress)")
+            self.server = create_server(
+                self.app, host=host, port=port, threads=threads, connection_limit=connection_limit,
+                ident='hans-platform'
+            )
+        else:
+            self.server = make_server(host, port, self.app, threaded=True)
         self.ctx = self.app.app_context()
         self.ctx.push()
     def run(self):
-        self.server.serve_forever()
+        if self.server_name == 'waitress':
+            self.server.run()
+        else:
+            self.server.serve_forever()
 
     def shutdown(self):
-        self.server.shutdown()
+        if self.server_name == 'waitress':
+            self._shutdown_waitress()
+        else:
+            self.server.shutdown()
+        self.join(self.shutdown_timeout)
+
+    def _shutdown_waitress(self):
+        '''
+            Stops accepting connections, lets the workers serve the requests
+            already received (up to shutdown_timeout) and then closes the
+            connections left, which ends the event loop.
+        '''
+        from waitress import wasyncore
+        from waitress.channel import HTTPChannel
+        from waitress.server import BaseWSGIServer, MultiSocketServer
+        from waitress.trigger import trigger
+
+        server = self.server
+        socket_map = server.map if isinstance(server, MultiSocketServer) else server._map
+        loop_trigger = next(d for d in list(socket_map.values()) if isinstance(d, trigger))
+        deadline = time.monotonic() + self.shutdown_timeout
+
+        # The sockets belong to the event loop thread, so they are closed there.
+        # Only the listeners: the trigger keeps the loop running
+        listeners_closed = Event()
+        def close_listeners():
+            for dispatcher in list(socket_map.values()):
+                if isinstance(dispatcher, BaseWSGIServer):
+                    wasyncore.dispatcher.close(dispatcher)
+            listeners_closed.set()
+        loop_trigger.pull_trigger(close_listeners)
+        listeners_closed.wait(max(0.0, deadline - time.monotonic()))
+
+        # A channel keeps its requests until they are served and its output
+        # until the client has read it
+        def busy():
+            return any(
+                isinstance(channel, HTTPChannel) and (channel.requests or channel.total_outbufs_len)
+                for channel in list(socket_map.values())
+            )
+        while busy() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        server.task_dispatcher.shutdown(cancel_pending=True, timeout=max(0.0, deadline - time.monotonic()))
+        loop_trigger.pull_trigger(lambda: wasyncore.close_all(socket_map))
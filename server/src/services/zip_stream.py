@@ -0,0 +1,164 @@
+import hashlib
+import io
+import json
+import os
+import zipfile
+from pathlib import Path
+from threading import Lock
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from flask import Response, send_file
+
+CHUNK_SIZE = 256 * 1024
+# Already compressed, deflating them again only costs CPU
+STORED_SUFFIXES = ('.zip', '.png', '.jpg', '.jpeg', '.gz')
+
+
+class _ChunkSink(io.RawIOBase):
+    '''
+        Write-only stream that keeps what ZipFile writes until it is taken by
+        the response. It cannot seek, so ZipFile writes data descriptors
+        instead of going back to patch the local headers.
+    '''
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def walk_files(folder: Path, exclude: Iterable[str] = ()) -> List[Tuple[str, Path]]:
+    """(arcname, path) of the files below folder, skipping dotfiles (files
+    still being written) and the names in exclude"""
+    exclude = set(exclude)
+    entries = []
+    for root, _, files in os.walk(folder):
+        for file in files:
+            if file.startswith('.') or file in exclude:
+                continue
+            path = Path(root) / file
+            entries.append((path.relative_to(folder).as_posix(), path))
+    return sorted(entries)
+
+
+def iter_zip(entries: Iterable[Tuple[str, Path]], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yields a zip archive of the entries as it is written, so the first bytes
+    go out before the last file has been read"""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+        for arcname, path in entries:
+            try:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                source = open(path, 'rb')
+            except FileNotFoundError:
+                # Deleted after the listing
+                continue
+            if path.suffix.lower() in STORED_SUFFIXES:
+                info.compress_type = zipfile.ZIP_STORED
+            with source, zipf.open(info, 'w') as target:
+                while True:
+                    data = source.read(chunk_size)
+                    if not data:
+                        break
+                    target.write(data)
+                    chunk = sink.take()
+                    if chunk:
+                        yield chunk
+            chunk = sink.take()
+            if chunk:
+                yield chunk
+    # Central directory
+    yield sink.take()
+
+
+def manifest_digest(entries: Iterable[Tuple[str, Path]]) -> str:
+    """Digest of the names, sizes and modification times of the entries: it
+    changes whenever the archive would"""
+    digest = hashlib.sha1()
+    for arcname, path in entries:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        digest.update(f"{arcname}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ZipArchiveCache():
+    '''
+        Archives of whole folders (all logs, all trajectories) served as zip
+        downloads. The first download after a change streams the archive while
+        it is built and keeps a copy; later downloads send that copy as long
+        as the manifest digest of the folder is the same.
+    '''
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self._lock = Lock()
+        self._building: Set[str] = set()
+
+    def _paths(self, name: str) -> Tuple[Path, Path]:
+        return self.cache_dir / name, self.cache_dir / f"{name}.manifest.json"
+
+    def cached_digest(self, name: str) -> Optional[str]:
+        archive_path, manifest_path = self._paths(name)
+        try:
+            with open(manifest_path) as f:
+                digest = json.load(f)['digest']
+        except (OSError, ValueError, KeyError):
+            return None
+        return digest if archive_path.is_file() else None
+
+    def response(self, name: str, entries: List[Tuple[str, Path]]) -> Response:
+        digest = manifest_digest(entries)
+        archive_path, _ = self._paths(name)
+        if self.cached_digest(name) == digest:
+            return send_file(archive_path.absolute(), mimetype='application/zip', as_attachment=True,
+                             download_name=name, etag=digest, conditional=True)
+        response = Response(self._build(name, entries, digest), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename={name}'
+        response.set_etag(digest)
+        return response
+
+    def _build(self, name: str, entries: List[Tuple[str, Path]], digest: str) -> Iterator[bytes]:
+        # Only one of the concurrent downloads of a changed folder writes the copy
+        with self._lock:
+            keep = name not in self._building
+            if keep:
+                self._building.add(name)
+        if not keep:
+            yield from iter_zip(entries)
+            return
+
+        archive_path, manifest_path = self._paths(name)
+        part_path = self.cache_dir / f".{name}.part"
+        completed = False
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(part_path, 'wb') as part:
+                for chunk in iter_zip(entries):
+                    part.write(chunk)
+                    yield chunk
+            os.replace(part_path, archive_path)
+            with open(manifest_path, 'w') as f:
+                json.dump({'digest': digest, 'entries': len(entries)}, f)
+            completed = True
+        finally:
+            # Also reached when the client disconnects before the end
+            if not completed and part_path.exists():
+                part_path.unlink()
+            with self._lock:
+                self._building.discard(name)